@@ -6,6 +6,7 @@ class BaseHandler:
         self._config = config
         self._messenger = messenger
         self._debug = config['debug']
+        self._http = service_hub.http
         self.key = key
         self.name = name
 
@@ -16,17 +17,38 @@ class BaseHandler:
             'examples': [],
         }
 
+    def setup(self, db):
+        pass
+
     def teardown(self):
         pass
 
+    # A line for /stats, e.g. cache hit rates.
+    def stats(self):
+        return None
+
     def matches_message(self, message):
         return False
 
+    # Lower case prefixes one of which a message has to start with for matches_message to be true.
+    # None means the handler can't tell, so it is asked about every message.
+    def routing_prefixes(self):
+        return None
+
+    # Same as routing_prefixes, for the end of the message.
+    def routing_suffixes(self):
+        return None
+
     def handle(self, message, **kwargs):
         pass
 
     def handle_button(self, data, **kwargs):
         pass
 
+    # When to call run_periodically, e.g. scheduler.Interval(60) or scheduler.Cron(minute=0, hour=6).
+    # Handlers that return None are never woken up.
+    def schedule(self):
+        return None
+
     def run_periodically(self, db):
         pass
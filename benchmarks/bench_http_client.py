@@ -0,0 +1,105 @@
+"""
+Latency of the HTTP requests behind "next trains" and "weather", made the way the bot used to
+(a bare requests.get, so a new connection every time) and through the shared HttpClient.
+
+"next trains" fetches the two home stationboards, "weather" fetches versions.json and the
+forecast. The stand-ins charge `--handshake` seconds per new connection in place of the TCP
+and TLS setup to the real servers. The last rows show what an unreachable host costs, also
+with a client that retries connect timeouts the way urllib3's Retry does by default.
+
+    python benchmarks/bench_http_client.py [--runs 50] [--handshake 0.03] [--latency 0.01]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from http_client import HttpClient  # noqa: E402
+from standins import MeteoStandin, TransportStandin, filled_listener  # noqa: E402
+
+
+def next_trains(get, transport):
+    for station in ('8591382', '8591123'):
+        get('{}/v1/stationboard?id={}&limit=30'.format(transport.url, station), timeout=7).json()
+
+
+def weather(get, meteo):
+    version = get('{}/product/output/versions.json'.format(meteo.url), timeout=7).json()['forecast-chart']
+    get('{}/product/output/forecast-chart/version__{}/en/800100.json'.format(meteo.url, version), timeout=7).json()
+
+
+def measure(runs, func, *args):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    print("{:<34} median {:7.1f} ms   p90 {:7.1f} ms   max {:7.1f} ms".format(
+        name,
+        1000 * statistics.median(timings),
+        1000 * timings[int(0.9 * (len(timings) - 1))],
+        1000 * timings[-1],
+    ))
+
+
+def unreachable(get, port, timeout):
+    try:
+        get('http://127.0.0.1:{}/'.format(port), timeout=timeout)
+    except requests.exceptions.RequestException:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--handshake', type=float, default=0.03)
+    parser.add_argument('--latency', type=float, default=0.01)
+    parser.add_argument('--connect-timeout', type=float, default=1.0)
+    args = parser.parse_args()
+
+    transport = TransportStandin(latency=args.latency, handshake=args.handshake).start()
+    meteo = MeteoStandin(latency=args.latency, handshake=args.handshake).start()
+    client = HttpClient({})
+    try:
+        print("{} runs, {:.0f} ms per new connection, {:.0f} ms per request\n".format(
+            args.runs, 1000 * args.handshake, 1000 * args.latency))
+        report("next trains, requests.get", measure(args.runs, next_trains, requests.get, transport))
+        report("next trains, HttpClient", measure(args.runs, next_trains, client.get, transport))
+        report("weather, requests.get", measure(args.runs, weather, requests.get, meteo))
+        report("weather, HttpClient", measure(args.runs, weather, client.get, meteo))
+
+        port, sockets = filled_listener()
+        try:
+            runs = 3
+            report("unreachable host, requests.get", measure(
+                runs, unreachable, requests.get, port, args.connect_timeout))
+            report("unreachable host, HttpClient", measure(
+                runs, unreachable, client.get, port, args.connect_timeout))
+            retrying = HttpClient({})
+            retrying.session.mount('http://', HTTPAdapter(max_retries=Retry(total=2, connect=2, backoff_factor=0.3)))
+            report("unreachable host, plain Retry", measure(
+                runs, unreachable, retrying.get, port, args.connect_timeout))
+            retrying.close()
+        finally:
+            for sock in sockets:
+                sock.close()
+    finally:
+        client.close()
+        transport.close()
+        meteo.close()
+
+
+if __name__ == '__main__':
+    main()
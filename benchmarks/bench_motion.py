@@ -0,0 +1,101 @@
+"""
+Cost per frame of the webcam motion check: WebcamHandler.motion_sample, which decodes a JPEG
+snapshot straight to a small grayscale sample, and MotionState.update, which diffs the sample
+with the background. For comparison the same diff is done on the full decoded frame, and the
+sample is also made without JPEG draft mode.
+
+The frames are synthetic: a noisy gradient, half of them with a bright block that moves
+around, so the changed fractions are printed as well.
+
+    python benchmarks/bench_motion.py [--size 1920x1080] [--frames 20] [--runs 5]
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from webcam_handler import MOTION_SIZE, MotionState, WebcamHandler  # noqa: E402
+
+
+def make_frames(size, count):
+    width, height = size
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(40, 200, width, dtype=np.float32)[np.newaxis, :].repeat(height, axis=0)
+    frames = []
+    for index in range(count):
+        pixels = gradient + rng.normal(0, 4, (height, width))
+        if index % 2:
+            # something moving: a bright block in a different place every time
+            x = (index * width // count) % (width - width // 5)
+            pixels[height // 3:height // 3 + height // 4, x:x + width // 5] = 250
+        rgb = np.clip(pixels, 0, 255).astype(np.uint8)[:, :, np.newaxis].repeat(3, axis=2)
+        buffer = io.BytesIO()
+        Image.fromarray(rgb).save(buffer, format='JPEG', quality=85)
+        frames.append(buffer.getvalue())
+    return frames
+
+
+def sample_without_draft(content):
+    im = Image.open(io.BytesIO(content))
+    im = im.convert('L').resize(MOTION_SIZE, Image.BILINEAR)
+    return np.asarray(im, dtype=np.float32) / 255
+
+
+def full_frame(content):
+    return np.asarray(Image.open(io.BytesIO(content)).convert('L'), dtype=np.float32) / 255
+
+
+def measure(runs, frames, sample):
+    """Per-frame seconds for sampling and for updating, and the changed fractions of the last run."""
+    sampling = []
+    updating = []
+    changed = []
+    for _ in range(runs):
+        state = MotionState({})
+        changed = []
+        for content in frames:
+            started = time.perf_counter()
+            picture = sample(content)
+            sampled = time.perf_counter()
+            changed.append(state.update(picture))
+            updated = time.perf_counter()
+            sampling.append(sampled - started)
+            updating.append(updated - sampled)
+    return sampling, updating, changed
+
+
+def report(name, sampling, updating, changed):
+    print("{:<24} sample {:8.2f} ms   update {:8.3f} ms   total {:8.2f} ms   changed {}".format(
+        name,
+        1000 * statistics.median(sampling),
+        1000 * statistics.median(updating),
+        1000 * (statistics.median(sampling) + statistics.median(updating)),
+        " ".join("{:.0%}".format(fraction) for fraction in changed[1:7]),
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', default='1920x1080')
+    parser.add_argument('--frames', type=int, default=20)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    size = tuple(int(part) for part in args.size.split('x'))
+    frames = make_frames(size, args.frames)
+    print("{} frames of {}x{}, {:.0f} kB per JPEG, medians per frame over {} runs\n".format(
+        args.frames, size[0], size[1], statistics.mean(len(content) for content in frames) / 1000, args.runs))
+    report("motion_sample", *measure(args.runs, frames, WebcamHandler.motion_sample))
+    report("without draft mode", *measure(args.runs, frames, sample_without_draft))
+    report("full frame", *measure(args.runs, frames, full_frame))
+
+
+if __name__ == '__main__':
+    main()
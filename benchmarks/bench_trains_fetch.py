@@ -0,0 +1,126 @@
+"""
+Time to get the stationboards for "next trains" one after the other, the way the bot used to,
+and with TrainsHandler.fetch_all, which asks for all of them at once and gives up on the ones
+that miss the deadline.
+
+Each case is run with a few healthy stations, then with one station that answers after
+`--slow` seconds, and then with one whose connection is dropped without an answer. The table
+shows the wall time and how many boards came back.
+
+    python benchmarks/bench_trains_fetch.py [--stations 4] [--runs 10] [--deadline 2] [--slow 5]
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import trains_handler  # noqa: E402
+from service_hub import ServiceHub  # noqa: E402
+from standins import DropConnection, TransportStandin  # noqa: E402
+
+SLOW_STATION = '8500666'
+BROKEN_STATION = '8500500'
+
+
+class FlakyTransportStandin(TransportStandin):
+    """Answers SLOW_STATION's stationboard `slow` seconds late and drops BROKEN_STATION's."""
+
+    slow = 0.0
+
+    def delay_for(self, path, query):
+        extra = self.slow if query.get('id') == SLOW_STATION else 0
+        return super().delay_for(path, query) + extra
+
+    def route(self, path, query):
+        if query.get('id') == BROKEN_STATION:
+            raise DropConnection()
+        return super().route(path, query)
+
+
+def serial(handler, stations):
+    # what stationboard_message did before fetch_all: one request after the other, and any
+    # failure failed the whole message
+    return [handler.fetch_stationboard(station, trains_handler.REQUEST_TIMEOUT)[1] for station in stations]
+
+
+def with_fetch_all(handler, stations):
+    return handler.get_boards(stations, None, time.monotonic() + handler.deadline)
+
+
+def measure(runs, func, handler, stations):
+    timings = []
+    boards = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        try:
+            boards = len(func(handler, stations))
+        except Exception:
+            boards = None
+        timings.append(time.perf_counter() - started)
+    return timings, boards
+
+
+def report(name, timings, boards, total):
+    print("{:<28} median {:7.1f} ms   max {:7.1f} ms   boards {}".format(
+        name,
+        1000 * statistics.median(timings),
+        1000 * max(timings),
+        "{}/{}".format(boards, total) if boards is not None else "failed",
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stations', type=int, default=4)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--deadline', type=float, default=2.0)
+    parser.add_argument('--slow', type=float, default=5.0)
+    parser.add_argument('--handshake', type=float, default=0.03)
+    parser.add_argument('--latency', type=float, default=0.15)
+    args = parser.parse_args()
+
+    # the dropped stations are logged by fetch_all on every run
+    logging.basicConfig(level=logging.ERROR)
+
+    standin = FlakyTransportStandin(latency=args.latency, handshake=args.handshake).start()
+    standin.slow = args.slow
+    trains_handler.STATIONBOARD_URL = standin.url + '/v1/stationboard?id={}&limit=30'
+    config = {
+        'debug': False,
+        'trains': {
+            'home_stations': [],
+            'home_types': [],
+            'deadline': args.deadline,
+            'fetch_workers': args.stations,
+        },
+    }
+    service_hub = ServiceHub(config)
+    handler = trains_handler.TrainsHandler(config, None, service_hub)
+    healthy = [str(8591000 + index) for index in range(args.stations)]
+    cases = [
+        ("healthy", healthy, args.runs),
+        ("one slow", healthy[:-1] + [SLOW_STATION], max(1, args.runs // 5)),
+        ("one dropped", healthy[:-1] + [BROKEN_STATION], args.runs),
+    ]
+    try:
+        print("{} stations, {:.0f} ms per request, {:.0f} ms per new connection, deadline {:.1f} s, "
+              "slow station answers after {:.1f} s\n".format(
+                  args.stations, 1000 * args.latency, 1000 * args.handshake, args.deadline, args.slow))
+        for name, stations, runs in cases:
+            report("{}, serial".format(name), *measure(runs, serial, handler, stations), len(stations))
+            report("{}, fetch_all".format(name), *measure(runs, with_fetch_all, handler, stations), len(stations))
+            if name == "one slow":
+                # let the requests left behind at the deadline finish before the next case
+                time.sleep(args.slow)
+    finally:
+        handler.teardown()
+        service_hub.teardown()
+        standin.close()
+
+
+if __name__ == '__main__':
+    main()
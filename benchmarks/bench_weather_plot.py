@@ -0,0 +1,93 @@
+"""
+Render time and memory of weather_plotter.generate_plot over many renders of a sample forecast.
+
+Prints the time per render and the process' peak and current RSS every few hundred renders.
+Plots go through WeatherHandler.render_plot, on the calling thread by default or in a pool of
+--processes worker processes, whose memory isn't counted then. With --pyplot the same plot is
+drawn the way the plotter used to: with pyplot.subplots and without closing the figure, so the
+growth of that can be compared.
+
+    python benchmarks/bench_weather_plot.py [--renders 1000] [--processes 0] [--pyplot]
+"""
+import argparse
+import logging
+import os
+import resource
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import weather_plotter  # noqa: E402
+from service_hub import ServiceHub  # noqa: E402
+from standins import sample_forecast  # noqa: E402
+from weather_handler import WeatherHandler  # noqa: E402
+
+
+def current_rss_mb():
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def pyplot_render(forecast):
+    import io
+    from matplotlib import pyplot as plt
+
+    series, _, _ = weather_plotter.window(forecast)
+    fig, ax1 = plt.subplots(figsize=(6, 3))
+    ax1.bar(series['time'] - 1750, series['rain'], 3500, color='#aaaaff')
+    ax2 = ax1.twinx()
+    ax2.plot(series['time'], series['temp'], 'w', linewidth=3)
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', facecolor='k', edgecolor='none', transparent=True, bbox_inches='tight', dpi=100)
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--renders', type=int, default=1000)
+    parser.add_argument('--report-every', type=int, default=200)
+    parser.add_argument('--processes', type=int, default=0)
+    parser.add_argument('--pyplot', action='store_true')
+    args = parser.parse_args()
+
+    # the ConkyWeather font is rarely installed, which matplotlib would complain about on every render
+    logging.getLogger('matplotlib.font_manager').setLevel(logging.ERROR)
+
+    forecast = weather_plotter.parse_forecast(sample_forecast())
+    config = {'debug': False, 'weather': {'plot_processes': args.processes}}
+    handler = WeatherHandler(config, None, ServiceHub(config))
+    render = pyplot_render if args.pyplot else handler.render_plot
+    render(forecast)  # warm up font cache and imports
+
+    if args.pyplot:
+        name = "pyplot.subplots"
+    elif args.processes:
+        name = "render_plot in {} processes".format(args.processes)
+    else:
+        name = "render_plot"
+    print("{} renders with {}, RSS {:.0f} MB after warm-up\n".format(args.renders, name, current_rss_mb()))
+    timings = []
+    for index in range(1, args.renders + 1):
+        started = time.perf_counter()
+        render(forecast)
+        timings.append(time.perf_counter() - started)
+        if index % args.report_every == 0 or index == args.renders:
+            recent = timings[-args.report_every:]
+            print("{:5d} renders   median {:6.1f} ms   max {:6.1f} ms   RSS {:6.0f} MB   peak {:6.0f} MB".format(
+                index, 1000 * statistics.median(recent), 1000 * max(recent), current_rss_mb(), peak_rss_mb()))
+
+    print("\noverall median {:.1f} ms, p90 {:.1f} ms".format(
+        1000 * statistics.median(timings), 1000 * sorted(timings)[int(0.9 * (len(timings) - 1))]))
+    handler.teardown()
+
+
+if __name__ == '__main__':
+    main()
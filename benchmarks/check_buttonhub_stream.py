@@ -0,0 +1,132 @@
+"""
+Runs ButtonhubService against the local Buttonhub stand-in and walks through the stream paths:
+the initial snapshot, update events (including a non-ASCII topic and a removal), falling back
+to /state polling when the stream drops or is refused, and reconnecting afterwards. Change
+listeners and the battery handler's low battery warning are checked along the way. Measures
+reading a few devices from the mirror compared with copying the whole state, and finally
+checks a stream sent without chunked transfer encoding.
+
+    python benchmarks/check_buttonhub_stream.py
+"""
+import os
+import sys
+import time
+import timeit
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from buttonhub_battery_handler import ButtonhubBatteryHandler  # noqa: E402
+from buttonhub_service import ButtonhubService  # noqa: E402
+from http_client import HttpClient  # noqa: E402
+from standins import ButtonhubStandin  # noqa: E402
+
+failures = 0
+
+
+class Messenger:
+    """Keeps the messages handlers send from their threads."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message_from_thread(self, message, **kwargs):
+        self.sent.append((message, kwargs.get('recipient_id')))
+
+
+def check(name, condition, timeout=5.0):
+    global failures
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            failures += 1
+            print("FAIL  {}".format(name))
+            return
+        time.sleep(0.02)
+    print("ok    {}".format(name))
+
+
+def main():
+    standin = ButtonhubStandin(state={
+        'living/lamp': {'state': 'ON'},
+        'kitchen/sensor': {'temperature': 21.5, 'battery': 80},
+    }).start()
+    http = HttpClient({})
+    service = ButtonhubService({'buttonhub': {
+        'base_url': standin.url,
+        'stream': '/events',
+        'state_ttl': 0,
+        'batteries': {'warning_threshold': 15, 'users': [42], 'hour': 9},
+    }}, http)
+    changes = []
+    service.add_listener(lambda topic, old, new: changes.append((topic, old, new)))
+    messenger = Messenger()
+    ButtonhubBatteryHandler({'debug': False}, messenger, types.SimpleNamespace(buttonhub=service, http=http))
+    service.start()
+    try:
+        check("snapshot received", lambda: service._stream_live)
+        check("snapshot mirrored", lambda: service.get_devices(['living/lamp']) == {'living/lamp': {'state': 'ON'}})
+
+        requests_before = standin.requests
+        service.get_devices(['living/lamp', 'kitchen/sensor'], refresh=True)
+        check("reads don't hit the server while the stream is live", lambda: standin.requests == requests_before)
+
+        standin.publish({'kitchen/sensor': {'temperature': 22.0}})
+        check("update merges fields", lambda: service.get_devices(['kitchen/sensor'])['kitchen/sensor']
+              == {'temperature': 22.0, 'battery': 80})
+        check("listener sees old and new state", lambda: changes[-1:] == [
+            ('kitchen/sensor', {'temperature': 21.5, 'battery': 80}, {'temperature': 22.0, 'battery': 80})])
+
+        standin.publish({'kitchen/sensor': {'battery': 12}})
+        check("low battery warned about right away",
+              lambda: messenger.sent == [("sensor is low on battery (12%)", 42)])
+        standin.publish({'kitchen/sensor': {'battery': 11}})
+        standin.publish({'kitchen/sensor': {'temperature': 22.5}})
+        check("later updates arrive", lambda: changes[-1][2] == {'temperature': 22.5, 'battery': 11})
+        check("but don't warn again", lambda: len(messenger.sent) == 1, timeout=0)
+
+        standin.publish({'Küche/Fenster': {'contact': 'offen'}})
+        check("non-ASCII topic decoded as UTF-8", lambda: service.get_devices(['Küche/Fenster'])['Küche/Fenster']
+              == {'contact': 'offen'})
+
+        standin.publish({'living/lamp': None})
+        check("null removes a topic", lambda: service.get_devices(['living/lamp'])['living/lamp'] is None)
+        check("listener sees the removal", lambda: changes[-1] == ('living/lamp', {'state': 'ON'}, None))
+
+        standin.stream_available = False
+        standin.drop_streams()
+        check("dropped stream falls back to polling", lambda: not service._stream_live)
+        standin.publish({'living/lamp': {'state': 'OFF'}})
+        check("polling serves /state", lambda: service.get_devices(['living/lamp'], refresh=True)['living/lamp']
+              == {'state': 'OFF'})
+
+        standin.stream_available = True
+        check("reconnects after backoff", lambda: service._stream_live, timeout=10)
+        standin.publish({'living/lamp': {'state': 'ON'}})
+        check("updates flow again", lambda: service.get_devices(['living/lamp'])['living/lamp'] == {'state': 'ON'})
+
+        standin.publish({'sensor/{}'.format(index): {'temperature': index} for index in range(500)})
+        check("500 topics mirrored", lambda: len(service.get_state()) >= 500)
+        runs = 10000
+        devices = timeit.timeit(lambda: service.get_devices(['kitchen/sensor', 'living/lamp']), number=runs)
+        state = timeit.timeit(lambda: service.get_state(), number=runs)
+        print("\nreading 2 of ~500 devices: get_devices {:.2f} µs, get_state {:.2f} µs".format(
+            1e6 * devices / runs, 1e6 * state / runs))
+
+        standin.chunked = False
+        standin.drop_streams()
+        check("chunked stream dropped", lambda: not service._stream_live)
+        check("reconnects to a stream without chunked encoding", lambda: service._stream_live, timeout=10)
+        standin.publish({'living/lamp': {'state': 'OFF'}})
+        check("its updates arrive right away", lambda: service.get_devices(['living/lamp'])['living/lamp']
+              == {'state': 'OFF'}, timeout=1)
+    finally:
+        service.teardown()
+        http.close()
+        standin.close()
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
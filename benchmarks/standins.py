@@ -0,0 +1,355 @@
+"""
+Local stand-ins for the HTTP APIs the bot talks to, used by the benchmarks and checks in this directory.
+
+They answer with made-up but correctly shaped data. `latency` delays every response and
+`handshake` delays every new connection once, which stands in for the TCP and TLS setup a
+real server far away would cost. Run this file to serve one of them by hand:
+
+    python benchmarks/standins.py transport --port 8001
+"""
+import argparse
+import http.server
+import json
+import queue
+import random
+import socket
+import threading
+import time
+import urllib.parse
+import zlib
+
+
+class DropConnection(Exception):
+    """Raised by a route to close the connection without answering."""
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes, which Nagle would hold back on a kept-alive connection
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.standin.connections += 1
+        if self.server.standin.handshake:
+            time.sleep(self.server.standin.handshake)
+
+    def do_GET(self):
+        standin = self.server.standin
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        standin.requests += 1
+        time.sleep(standin.delay_for(url.path, query))
+        try:
+            status, body, content_type = standin.route(url.path, query)
+        except DropConnection:
+            self.close_connection = True
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if isinstance(body, bytes):
+            self.send_header('Content-Length', str(len(body)))
+            try:
+                self.end_headers()
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # the client gave up waiting
+                self.close_connection = True
+            return
+        # A stream is sent as it comes, chunked like most servers do it, or else delimited by
+        # the end of the connection.
+        chunked = getattr(standin, 'chunked', True)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for chunk in body:
+                if chunked:
+                    chunk = b'%x\r\n%s\r\n' % (len(chunk), chunk)
+                self.wfile.write(chunk)
+                self.wfile.flush()
+            if chunked:
+                self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandinServer:
+    """An HTTP server on a free local port, serving from a background thread."""
+
+    def __init__(self, latency=0.0, handshake=0.0, port=0):
+        self.latency = latency
+        self.handshake = handshake
+        # path prefix -> seconds, on top of latency
+        self.delays = {}
+        self.requests = 0
+        self.connections = 0
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', port), _RequestHandler)
+        self._server.daemon_threads = True
+        self._server.standin = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def delay_for(self, path, query):
+        extra = max([delay for prefix, delay in self.delays.items() if path.startswith(prefix)], default=0)
+        return self.latency + extra
+
+    def route(self, path, query):
+        return 404, b'{}', 'application/json'
+
+    @staticmethod
+    def json(document):
+        return 200, json.dumps(document).encode('utf-8'), 'application/json'
+
+
+def _station_id(name):
+    return str(8500000 + zlib.crc32(name.lower().encode('utf-8')) % 100000)
+
+
+class TransportStandin(StandinServer):
+    """transport.opendata.ch: /v1/locations, /v1/stationboard and /v1/connections."""
+
+    def route(self, path, query):
+        if path == '/v1/locations':
+            name = query.get('query', '')
+            return self.json({'stations': [{'id': _station_id(name), 'name': name.title()}]})
+        if path == '/v1/stationboard':
+            return self.json(self.stationboard(query['id']))
+        if path == '/v1/connections':
+            return self.json(self.connections_between(query['from'], query['to']))
+        return super().route(path, query)
+
+    @staticmethod
+    def stationboard(station_id, departures=30):
+        now = int(time.time())
+        rng = random.Random(station_id)
+        board = []
+        for index in range(departures):
+            departure = now + 60 * (2 + 2 * index)
+            delay = rng.choice([None, 0, 0, 1, 3])
+            board.append({
+                'category': rng.choice(['T', 'BUS', 'S', 'IR']),
+                'number': str(rng.randint(1, 33)),
+                'to': rng.choice(['Zürich, Bellevue', 'Oerlikon', 'Wollishofen', 'Stettbach']),
+                'stop': {
+                    'departureTimestamp': departure,
+                    'delay': delay,
+                    'prognosis': {
+                        'departure': time.strftime(
+                            '%Y-%m-%dT%H:%M:%S%z', time.localtime(departure + 60 * (delay or 0)))
+                        if delay is not None else None,
+                    },
+                },
+            })
+        return {'station': {'id': station_id, 'name': 'Station {}'.format(station_id)}, 'stationboard': board}
+
+    @staticmethod
+    def connections_between(from_id, to_id, count=4):
+        now = int(time.time())
+
+        def stop(name, timestamp):
+            return {
+                'station': {'id': _station_id(name), 'name': name},
+                'departureTimestamp': timestamp,
+                'arrivalTimestamp': timestamp,
+                'platform': '3',
+            }
+
+        connections = []
+        for index in range(count):
+            departure = now + 60 * (3 + 10 * index)
+            connections.append({
+                'from': stop(from_id, departure),
+                'to': stop(to_id, departure + 1800),
+                'duration': '00d00:30:00',
+                'sections': [
+                    {
+                        'journey': {'category': 'S', 'number': 'S12'},
+                        'walk': None,
+                        'departure': stop(from_id, departure),
+                        'arrival': stop('Zürich HB', departure + 900),
+                    },
+                    {
+                        'journey': {'category': 'IC', 'number': '5'},
+                        'walk': None,
+                        'departure': stop('Zürich HB', departure + 1080),
+                        'arrival': stop(to_id, departure + 1800),
+                    },
+                ],
+            })
+        return {'connections': connections}
+
+
+def sample_forecast(now=None, days=8):
+    """A forecast document shaped like MeteoSwiss' forecast-chart json, hourly for `days` days."""
+    now = int(now or time.time())
+    midnight = now - now % 86400
+    rng = random.Random(midnight)
+    document = []
+    for day in range(days):
+        temperature = []
+        rainfall = []
+        symbols = []
+        for hour in range(24):
+            timestamp = (midnight + day * 86400 + hour * 3600) * 1000
+            temp = 10 + 8 * rng.random()
+            temperature.append([timestamp, temp, temp - 2, temp + 2])
+            rainfall.append([timestamp, max(0.0, rng.gauss(0.2, 0.6))])
+            if hour % 3 == 0:
+                symbols.append({'timestamp': timestamp, 'weather_symbol_id': rng.randint(1, 35)})
+        document.append({
+            'current_time': now * 1000,
+            'temperature': temperature,
+            'rainfall': rainfall,
+            'symbols': symbols,
+        })
+    return document
+
+
+class MeteoStandin(StandinServer):
+    """MeteoSwiss: versions.json and forecast-chart/version__{}/en/{zip}.json."""
+
+    version = '20261018_1200'
+
+    def route(self, path, query):
+        if path == '/product/output/versions.json':
+            return self.json({'forecast-chart': self.version})
+        if path.startswith('/product/output/forecast-chart/'):
+            return self.json(sample_forecast())
+        return super().route(path, query)
+
+
+class ButtonhubStandin(StandinServer):
+    """
+    Buttonhub: /state and the server-sent events stream at /events, which starts with a
+    "snapshot" event and then sends an "update" event for every publish(). drop_streams()
+    ends all open streams, and with stream_available set to False new ones are refused.
+    With chunked set to False the stream is sent without chunked transfer encoding.
+    """
+
+    KEEPALIVE = 15
+
+    def __init__(self, state=None, **kwargs):
+        super().__init__(**kwargs)
+        self.state = dict(state or {})
+        self.stream_available = True
+        self.chunked = True
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def route(self, path, query):
+        if path == '/state':
+            with self._lock:
+                return self.json(self.state)
+        if path == '/events':
+            if not self.stream_available:
+                return 503, b'{}', 'application/json'
+            # no charset on purpose, event streams are UTF-8 by definition
+            return 200, self._events(), 'text/event-stream'
+        return super().route(path, query)
+
+    def publish(self, delta):
+        with self._lock:
+            for topic, fields in delta.items():
+                if fields is None:
+                    self.state.pop(topic, None)
+                else:
+                    self.state[topic] = dict(self.state.get(topic) or {}, **fields)
+            for subscriber in self._subscribers:
+                subscriber.put(delta)
+
+    def drop_streams(self):
+        with self._lock:
+            for subscriber in self._subscribers:
+                subscriber.put(None)
+
+    @staticmethod
+    def _event(event, document):
+        return 'event: {}\ndata: {}\n\n'.format(event, json.dumps(document, ensure_ascii=False)).encode('utf-8')
+
+    def _events(self):
+        subscriber = queue.Queue()
+        with self._lock:
+            self._subscribers.append(subscriber)
+            snapshot = self._event('snapshot', self.state)
+        try:
+            yield snapshot
+            while True:
+                try:
+                    delta = subscriber.get(timeout=self.KEEPALIVE)
+                except queue.Empty:
+                    yield b': keepalive\n\n'
+                    continue
+                if delta is None:
+                    return
+                yield self._event('update', delta)
+        finally:
+            with self._lock:
+                self._subscribers.remove(subscriber)
+
+
+def filled_listener():
+    """
+    A local port that never accepts a connection, so connecting to it runs into the connect
+    timeout like an unreachable host does. Returns (port, sockets to close when done).
+    """
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(0)
+    port = listener.getsockname()[1]
+    sockets = [listener]
+    # fill up the accept queue, further SYNs are dropped
+    for _ in range(4):
+        filler = socket.socket()
+        filler.setblocking(False)
+        try:
+            filler.connect(('127.0.0.1', port))
+        except BlockingIOError:
+            pass
+        sockets.append(filler)
+    time.sleep(0.1)
+    return port, sockets
+
+
+STANDINS = {
+    'transport': TransportStandin,
+    'meteo': MeteoStandin,
+    'buttonhub': ButtonhubStandin,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('api', choices=sorted(STANDINS))
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--handshake', type=float, default=0.0)
+    args = parser.parse_args()
+    server = STANDINS[args.api](latency=args.latency, handshake=args.handshake, port=args.port).start()
+    print("Serving {} stand-in at {}".format(args.api, server.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 from base_handler import *
-import datetime
 
 from buttonhub_service import ButtonhubError
+from scheduler import Cron
 from utils import PERM_ADMIN, get_timestamp
 
 UPDATE_LIST = 'up'
@@ -14,6 +14,10 @@ class ButtonhubBatteryHandler(BaseHandler):
         if self.buttonhub_service.enabled:
             self.config = self.buttonhub_service.get_config('batteries')
             self.enabled = bool(self.config)
+        if self.enabled:
+            # devices already warned about, until their battery is above the threshold again
+            self.warned = set()
+            self.buttonhub_service.add_listener(self.on_device_change)
 
     def help(self, permission):
         if not self.enabled:
@@ -30,14 +34,19 @@ class ButtonhubBatteryHandler(BaseHandler):
             return
         return message.lower().strip() == 'batteries'
 
+    def routing_prefixes(self):
+        if not self.enabled:
+            return []
+        return ['batteries']
+
     def handle(self, message, **kwargs):
         if kwargs['permission'] < PERM_ADMIN:
             return "Sorry, you can't do this."
         return self.check_batteries()
 
-    def check_batteries(self, include_timestamp=False):
+    def check_batteries(self, include_timestamp=False, refresh=False):
         try:
-            battery_status = self._get_battery_status()
+            battery_status = self._get_battery_status(refresh=refresh)
 
             if not battery_status:
                 message = 'No devices found'
@@ -65,38 +74,56 @@ class ButtonhubBatteryHandler(BaseHandler):
                 'answer': 'Error!',
             }
 
-    def _get_battery_status(self):
+    def _get_battery_status(self, refresh=False):
         battery_status = []
 
-        buttonhub_state = self.buttonhub_service.get_state()
+        buttonhub_state = self.buttonhub_service.get_state(refresh=refresh)
         for device, value in buttonhub_state.items():
             battery = value.get('battery')
             if battery:
-                device_name = device
-                if '/' in device_name:
-                    device_name = device_name.split('/')[1]
                 battery_status.append(
-                    {'device': device_name, 'battery': int(battery)}
+                    {'device': self._device_name(device), 'battery': int(battery)}
                 )
 
         battery_status.sort(key=lambda entry: entry['device'])
 
         return battery_status
 
+    @staticmethod
+    def _device_name(topic):
+        if '/' in topic:
+            return topic.split('/')[1]
+        return topic
+
+    def on_device_change(self, topic, old, new):
+        # Called by the state stream, so a device running low is reported right away and not
+        # only with the next scheduled check.
+        battery = (new or {}).get('battery')
+        if not battery:
+            return
+        if int(battery) > self.config['warning_threshold']:
+            self.warned.discard(topic)
+            return
+        if topic in self.warned:
+            return
+        self.warned.add(topic)
+        message = "{} is low on battery ({}%)".format(self._device_name(topic), int(battery))
+        for user in self.config['users']:
+            self._messenger.send_message_from_thread(message, recipient_id=user)
+
     def handle_button(self, data, **kwargs):
         if data == UPDATE_LIST:
-            msg = self.check_batteries(include_timestamp=True)
+            msg = self.check_batteries(include_timestamp=True, refresh=True)
             msg['answer'] = "Updated."
             return msg
         return "Uh oh, something is off"
 
-    def run_periodically(self, db):
+    def schedule(self):
         if not self.enabled:
-            return
-        now = datetime.datetime.now()
-        if now.hour != self.config['hour'] or now.minute != 0 or (now.day % 5) != 1:
-            return
+            return None
+        return Cron(minute=0, hour=self.config['hour'], days=[day for day in range(1, 32) if day % 5 == 1])
 
+    def run_periodically(self, db):
         threshold = self.config['warning_threshold']
 
         battery_status = self._get_battery_status()
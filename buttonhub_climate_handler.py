@@ -29,16 +29,24 @@ class ButtonhubClimateHandler(BaseHandler):
             return
         return message.lower().strip() == 'climate'
 
+    def routing_prefixes(self):
+        if not self.enabled:
+            return []
+        return ['climate']
+
     def handle(self, message, **kwargs):
         if kwargs['permission'] < PERM_ADMIN:
             return "Sorry, you can't do this."
         return self.check_climate()
 
-    def check_climate(self, include_timestamp=False):
+    def check_climate(self, include_timestamp=False, refresh=False):
         try:
             room_states = []
 
-            buttonhub_state = self.buttonhub_service.get_state()
+            buttonhub_state = self.buttonhub_service.get_devices(
+                [device['name'] for room in self.rooms for device in room.get('sensors', [])],
+                refresh=refresh,
+            )
             for room in self.rooms:
                 room_state = []
                 for device in room.get('sensors', []):
@@ -91,7 +99,7 @@ class ButtonhubClimateHandler(BaseHandler):
 
     def handle_button(self, data, **kwargs):
         if data == UPDATE_LIST:
-            msg = self.check_climate(include_timestamp=True)
+            msg = self.check_climate(include_timestamp=True, refresh=True)
             msg['answer'] = "Updated."
             return msg
         return "Uh oh, something is off"
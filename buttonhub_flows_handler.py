@@ -32,6 +32,11 @@ class ButtonhubFlowsHandler(BaseHandler):
         m = message.lower().strip()
         return RUN_FLOW_REGEX.match(message) is not None or m == 'flow' or m == 'flows' or m.startswith('flows ')
 
+    def routing_prefixes(self):
+        if not self.enabled:
+            return []
+        return ['run flow ', 'flow']
+
     def handle(self, message, **kwargs):
         m = message.lower().strip()
         if kwargs['permission'] < PERM_ADMIN:
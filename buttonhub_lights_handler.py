@@ -30,19 +30,27 @@ class ButtonhubLightsHandler(BaseHandler):
             return
         return message.lower().strip() == 'lights'
 
+    def routing_prefixes(self):
+        if not self.enabled:
+            return []
+        return ['lights']
+
     def handle(self, message, **kwargs):
         if kwargs['permission'] < PERM_ADMIN:
             return "Sorry, you can't do this."
         return self.check_lights()
 
-    def check_lights(self, include_timestamp=False):
+    def check_lights(self, include_timestamp=False, refresh=False):
         default_field = self.lights['default_field']
         default_on_state = self.lights['default_on_state']
 
         try:
             lights_on_in = []
 
-            buttonhub_state = self.buttonhub_service.get_state()
+            buttonhub_state = self.buttonhub_service.get_devices(
+                [device['name'] for room in self.rooms for device in room['lights']],
+                refresh=refresh,
+            )
             for room in self.rooms:
                 for device in room['lights']:
                     device_name = device['name']
@@ -76,7 +84,7 @@ class ButtonhubLightsHandler(BaseHandler):
 
     def handle_button(self, data, **kwargs):
         if data == UPDATE_LIST:
-            msg = self.check_lights(include_timestamp=True)
+            msg = self.check_lights(include_timestamp=True, refresh=True)
             msg['answer'] = "Updated."
             return msg
         return "Uh oh, something is off"
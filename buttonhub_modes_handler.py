@@ -30,15 +30,23 @@ class ButtonhubModesHandler(BaseHandler):
             return
         return message.lower().strip() == 'modes'
 
+    def routing_prefixes(self):
+        if not self.enabled:
+            return []
+        return ['modes']
+
     def handle(self, message, **kwargs):
         if kwargs['permission'] < PERM_ADMIN:
             return "Sorry, you can't do this."
         return self.check_modes()
 
-    def check_modes(self, include_timestamp=False):
+    def check_modes(self, include_timestamp=False, refresh=False):
         try:
             result = []
-            buttonhub_state = self.buttonhub_service.get_state()
+            buttonhub_state = self.buttonhub_service.get_devices(
+                [mode.get('topic') or '' for mode in self.modes],
+                refresh=refresh,
+            )
             for mode in self.modes:
                 type = mode.get('type')
                 display_name = mode.get('display_name')
@@ -79,7 +87,7 @@ class ButtonhubModesHandler(BaseHandler):
 
     def handle_button(self, data, **kwargs):
         if data == UPDATE_LIST:
-            msg = self.check_modes(include_timestamp=True)
+            msg = self.check_modes(include_timestamp=True, refresh=True)
             msg['answer'] = "Updated."
             return msg
         return "Uh oh, something is off"
@@ -1,9 +1,26 @@
+import json
+import logging
+import threading
+import time
+
 import requests
 
+logger = logging.getLogger(__name__)
+
+DEFAULT_STATE_TTL = 10
+
+# The stream is expected to be server-sent events: a "snapshot" event carrying the full state
+# document, followed by "update" events carrying {topic: new fields} deltas (null removes a
+# topic). The server should send a comment line every now and then to keep the read alive.
+STREAM_READ_TIMEOUT = 90
+STREAM_MIN_BACKOFF = 1
+STREAM_MAX_BACKOFF = 60
+
 
 class ButtonhubService:
 
-    def __init__(self, config):
+    def __init__(self, config, http):
+        self.http = http
         if 'buttonhub' in config:
             self.config = config['buttonhub']
             self.base_url = config['buttonhub']['base_url']
@@ -11,13 +28,74 @@ class ButtonhubService:
         else:
             self.config = {}
             self.enabled = False
+        self.state_ttl = self.config.get('state_ttl', DEFAULT_STATE_TTL)
+        self._state = None
+        self._state_fetched_at = 0
+        self._state_lock = threading.Lock()
+
+        self.stream_path = self.config.get('stream')
+        self._mirror = {}
+        self._mirror_lock = threading.Lock()
+        self._stream_live = False
+        self._stream_response = None
+        self._stream_thread = None
+        self._stream_exit = threading.Event()
+        self._listeners = []
+
+    def start(self):
+        if not self.enabled or not self.stream_path:
+            return
+        self._stream_thread = threading.Thread(target=self._stream_run, name='buttonhub-stream', daemon=True)
+        self._stream_thread.start()
+
+    def teardown(self):
+        self._stream_exit.set()
+        response = self._stream_response
+        if response is not None:
+            response.close()
+
+    def add_listener(self, callback):
+        # callback(topic, old, new) is called on the stream thread for every topic an update event
+        # changes; old is None for a new topic and new is None for a removed one. Nothing is called
+        # while polling.
+        self._listeners.append(callback)
+
+    def get_devices(self, topics, refresh=False):
+        # With the stream live these are plain lookups in the mirror, whose entries are never
+        # changed in place; otherwise all topics come from one (shared) /state fetch.
+        if self._stream_live:
+            mirror = self._mirror
+            return {topic: mirror.get(topic) for topic in topics}
+        state = self.get_state(refresh=refresh)
+        return {topic: state.get(topic) for topic in topics}
 
     def get_config(self, name):
         return self.config.get(name) or {}
 
-    def get_state(self):
+    def get_state(self, refresh=False):
+        # Callers share one snapshot for state_ttl seconds. Concurrent callers wait for the fetch
+        # that is already in flight instead of starting their own; with refresh, only a fetch
+        # that started after the call is good enough.
+        if self._stream_live:
+            with self._mirror_lock:
+                return dict(self._mirror)
+        requested_at = time.monotonic()
+        with self._state_lock:
+            if self._state is not None:
+                if refresh:
+                    fresh = self._state_fetched_at >= requested_at
+                else:
+                    fresh = requested_at - self._state_fetched_at < self.state_ttl
+                if fresh:
+                    return self._state
+            fetched_at = time.monotonic()
+            self._state = self._fetch_state()
+            self._state_fetched_at = fetched_at
+            return self._state
+
+    def _fetch_state(self):
         try:
-            response = requests.get(f'{self.base_url}/state', timeout=5)
+            response = self.http.get(f'{self.base_url}/state', timeout=5)
             response.raise_for_status()
             return response.json()
         except requests.HTTPError:
@@ -25,9 +103,86 @@ class ButtonhubService:
         except requests.exceptions.ConnectionError:
             raise ButtonhubError
 
+    def _stream_run(self):
+        session = requests.Session()
+        backoff = STREAM_MIN_BACKOFF
+        while not self._stream_exit.is_set():
+            try:
+                with session.get(
+                    f'{self.base_url}{self.stream_path}',
+                    headers={'Accept': 'text/event-stream'},
+                    stream=True,
+                    timeout=(5, STREAM_READ_TIMEOUT),
+                ) as response:
+                    response.raise_for_status()
+                    self._stream_response = response
+                    logger.info("Connected to buttonhub state stream")
+                    for event, data in self._read_events(response):
+                        self._apply_event(event, data)
+                        backoff = STREAM_MIN_BACKOFF
+            except Exception as e:
+                if not self._stream_exit.is_set():
+                    logger.warning("Buttonhub state stream unavailable, polling instead: {}".format(e))
+            finally:
+                self._stream_live = False
+                self._stream_response = None
+            self._stream_exit.wait(backoff)
+            backoff = min(backoff * 2, STREAM_MAX_BACKOFF)
+        session.close()
+
+    @staticmethod
+    def _read_events(response):
+        # event streams are always UTF-8; without a charset requests would assume ISO-8859-1
+        response.encoding = 'utf-8'
+        event = 'message'
+        data = []
+        # chunk_size=None hands out chunks as they arrive, but only for chunked responses; on a
+        # stream that ends with the connection it would wait for the end. Events are small, so
+        # reading those byte by byte is cheap enough.
+        chunked = 'chunked' in response.headers.get('Transfer-Encoding', '').lower()
+        for line in response.iter_lines(chunk_size=None if chunked else 1, decode_unicode=True):
+            if not line:
+                if data:
+                    yield event, '\n'.join(data)
+                event = 'message'
+                data = []
+            elif line.startswith(':'):
+                continue
+            elif line.startswith('event:'):
+                event = line[6:].strip()
+            elif line.startswith('data:'):
+                data.append(line[5:].lstrip())
+
+    def _apply_event(self, event, data):
+        payload = json.loads(data)
+        if event == 'snapshot':
+            with self._mirror_lock:
+                self._mirror = payload
+            self._stream_live = True
+            return
+        if not self._stream_live:
+            # deltas are meaningless until we have seen a snapshot
+            return
+        for topic, fields in payload.items():
+            with self._mirror_lock:
+                old = self._mirror.get(topic)
+                if fields is None:
+                    self._mirror.pop(topic, None)
+                    state = None
+                else:
+                    # copy on write, so entries handed out by get_state and get_devices never change under the reader
+                    state = dict(old or {})
+                    state.update(fields)
+                    self._mirror[topic] = state
+            for listener in self._listeners:
+                try:
+                    listener(topic, old, state)
+                except Exception as e:
+                    logger.exception(e)
+
     def run_flow(self, flow_name):
         try:
-            response = requests.post(f'{self.base_url}/flows/{flow_name}', timeout=5)
+            response = self.http.post(f'{self.base_url}/flows/{flow_name}', timeout=5)
             response.raise_for_status()
         except requests.HTTPError:
             raise ButtonhubError
@@ -36,7 +191,7 @@ class ButtonhubService:
 
     def get_flows(self):
         try:
-            response = requests.get(f'{self.base_url}/flows', timeout=5)
+            response = self.http.get(f'{self.base_url}/flows', timeout=5)
             response.raise_for_status()
             return response.json()['flows']
         except requests.HTTPError:
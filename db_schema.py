@@ -0,0 +1,149 @@
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def to_epoch(value):
+    if value is None:
+        return None
+    return int(value.timestamp())
+
+
+def from_epoch(value):
+    if value is None:
+        return None
+    return datetime.datetime.fromtimestamp(value)
+
+
+def parse_legacy_datetime(value):
+    # dataset returns dates as string from raw queries but only accepts them as datetime
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return None
+
+
+class RowAdapter:
+    """Converts between rows storing timestamps as integer epochs and dicts holding datetimes."""
+
+    def __init__(self, **columns):
+        # field name -> name of the epoch column it is stored in
+        self.columns = columns
+
+    def load(self, row):
+        if row is None:
+            return None
+        item = dict(row)
+        for field, column in self.columns.items():
+            item[field] = from_epoch(item.pop(column, None))
+        return item
+
+    def dump(self, item):
+        row = dict(item)
+        for field, column in self.columns.items():
+            if field in row:
+                row[column] = to_epoch(row.pop(field))
+        return row
+
+
+REMINDERS = RowAdapter(next='next_ts')
+WEKAN_REPORTS = RowAdapter(next_message='next_message_ts')
+TRAIN_AUTO_REFRESH = RowAdapter(until='until_ts')
+
+
+def _epoch_column(db, table_name, legacy_column, column):
+    # the legacy datetime column is left in place but no longer written
+    table = db.create_table(table_name)
+    table.create_column(column, db.types.bigint)
+    if not table.has_column(legacy_column):
+        return
+    for row in db.query('SELECT id, {} FROM {}'.format(legacy_column, table_name)):
+        value = parse_legacy_datetime(row[legacy_column])
+        if value is not None:
+            table.update({'id': row['id'], column: to_epoch(value)}, ['id'])
+
+
+def _migrate_epochs_and_indexes(db):
+    _epoch_column(db, 'reminders', 'next', 'next_ts')
+    _epoch_column(db, 'wekan', 'next_message', 'next_message_ts')
+    _epoch_column(db, 'train_auto_refresh', 'until', 'until_ts')
+
+    reminders = db.create_table('reminders')
+    reminders.create_column('active', db.types.boolean)
+    reminders.create_index(['active', 'next_ts'])
+
+    wekan = db.create_table('wekan')
+    wekan.create_column('enabled', db.types.boolean)
+    wekan.create_index(['enabled', 'next_message_ts'])
+
+    train_auto_refresh = db.create_table('train_auto_refresh')
+    train_auto_refresh.create_column('message', db.types.bigint)
+    train_auto_refresh.create_index(['message'])
+
+    groceries = db.create_table('groceries')
+    groceries.create_column('list', db.types.text)
+    groceries.create_index(['list'])
+
+    inventory = db.create_table('inventory')
+    inventory.create_column('name', db.types.text)
+    inventory.create_index(['name'])
+
+
+def _migrate_weather_locations(db):
+    locations = db.create_table('weather_locations')
+    locations.create_column('prefix', db.types.text)
+    locations.create_column('zip', db.types.text)
+    locations.create_column('canton', db.types.text)
+    locations.create_column('name', db.types.text)
+    locations.create_column('name_norm', db.types.text)
+    locations.create_index(['name_norm'])
+    locations.create_index(['prefix'])
+
+    prefixes = db.create_table('weather_location_prefixes')
+    prefixes.create_column('prefix', db.types.text)
+    prefixes.create_column('fetched_ts', db.types.bigint)
+    prefixes.create_index(['prefix'])
+
+
+def _migrate_weather_subscriptions(db):
+    subscriptions = db.create_table('weather_subscriptions')
+    subscriptions.create_column('actor', db.types.bigint)
+    subscriptions.create_column('last_push', db.types.text)
+    subscriptions.create_index(['actor'])
+
+
+def _migrate_train_stations(db):
+    stations = db.create_table('train_stations')
+    stations.create_column('query_norm', db.types.text)
+    stations.create_column('station_id', db.types.text)
+    stations.create_column('fetched_ts', db.types.bigint)
+    stations.create_index(['query_norm'])
+
+
+def _migrate_train_auto_refresh_hash(db):
+    train_auto_refresh = db.create_table('train_auto_refresh')
+    train_auto_refresh.create_column('last_hash', db.types.text)
+
+
+# Append only. The position in this list is the schema version stored in PRAGMA user_version.
+# Migrations have to be safe to run again, in case the bot dies halfway through one.
+MIGRATIONS = [
+    _migrate_epochs_and_indexes,
+    _migrate_weather_locations,
+    _migrate_weather_subscriptions,
+    _migrate_train_stations,
+    _migrate_train_auto_refresh_hash,
+]
+
+
+def migrate(db):
+    version = next(iter(db.query('PRAGMA user_version')))['user_version']
+    for index, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info("Migrating database to version {}".format(index))
+        migration(db)
+        db.query('PRAGMA user_version = {}'.format(index))
@@ -19,6 +19,9 @@ class DiceHandler(BaseHandler):
     def matches_message(self, message):
         return (COIN_FLIP_REGEX.match(message) is not None) or (DICE_ROLL_REGEX.match(message) is not None)
     
+    def routing_prefixes(self):
+        return ['flip ', 'roll']
+
     def handle(self, message, **kwargs):
         coins = COIN_FLIP_REGEX.match(message)
         if coins is not None:
@@ -0,0 +1,131 @@
+import asyncio
+import concurrent.futures
+import inspect
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+DEFAULT_HANDLER_CONCURRENCY = 2
+DEFAULT_SLOW_WAIT = 1.0
+
+
+class HandlerStats:
+    def __init__(self):
+        self.calls = 0
+        self.waiting = 0
+        self.running = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+        self.max_run = 0.0
+
+    def record(self, wait, run):
+        self.calls += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.total_run += run
+        self.max_run = max(self.max_run, run)
+
+    def describe(self):
+        calls = self.calls or 1
+        return "{} calls, wait avg {:.0f} ms / max {:.0f} ms, run avg {:.0f} ms / max {:.0f} ms, {} waiting, {} running".format(
+            self.calls,
+            1000 * self.total_wait / calls,
+            1000 * self.max_wait,
+            1000 * self.total_run / calls,
+            1000 * self.max_run,
+            self.waiting,
+            self.running,
+        )
+
+
+class Dispatcher:
+    """Runs handler methods in a bounded thread pool (or awaits them if they are coroutines)."""
+
+    def __init__(self, config):
+        dispatch_config = config.get('dispatch') or {}
+        self.debug = config['debug']
+        self.default_limit = dispatch_config.get('handler_concurrency', DEFAULT_HANDLER_CONCURRENCY)
+        self.limits = dispatch_config.get('limits') or {}
+        self.slow_wait = dispatch_config.get('slow_wait', DEFAULT_SLOW_WAIT)
+        self.workers = dispatch_config.get('workers', DEFAULT_WORKERS)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix='handler',
+        )
+        self.semaphores = {}
+        self.stats = {}
+
+    def _semaphore(self, key):
+        if key not in self.semaphores:
+            self.semaphores[key] = asyncio.Semaphore(self.limits.get(key, self.default_limit))
+        return self.semaphores[key]
+
+    def _stats(self, key):
+        if key not in self.stats:
+            self.stats[key] = HandlerStats()
+        return self.stats[key]
+
+    async def run(self, handler, method, *args, **kwargs):
+        # The counters are only ever touched on the event loop thread; the worker only
+        # notes when it started and hands the bookkeeping back to the loop.
+        stats = self._stats(handler.key)
+        loop = asyncio.get_running_loop()
+        enqueued = time.monotonic()
+        started = None
+        marked = False
+        finished = False
+
+        def mark_started():
+            nonlocal marked
+            if finished:
+                # the caller already gave up on this call and counted it as done
+                return
+            marked = True
+            stats.waiting -= 1
+            stats.running += 1
+
+        def call():
+            nonlocal started
+            started = time.monotonic()
+            loop.call_soon_threadsafe(mark_started)
+            return method(*args, **kwargs)
+
+        stats.waiting += 1
+        try:
+            async with self._semaphore(handler.key):
+                if inspect.iscoroutinefunction(method):
+                    started = time.monotonic()
+                    mark_started()
+                    return await method(*args, **kwargs)
+                return await loop.run_in_executor(self.executor, call)
+        finally:
+            finished = True
+            ended = time.monotonic()
+            if marked:
+                stats.running -= 1
+            else:
+                # cancelled or failed before the loop heard that the handler started
+                stats.waiting -= 1
+            if started is None:
+                started = ended
+            wait = started - enqueued
+            run = ended - started
+            stats.record(wait, run)
+            if wait >= self.slow_wait:
+                logger.warning("Handler {} was queued for {:.0f} ms".format(handler.key, 1000 * wait))
+            if self.debug:
+                logger.info("Handler {} waited {:.0f} ms, ran {:.0f} ms".format(handler.key, 1000 * wait, 1000 * run))
+
+    def describe(self):
+        if not self.stats:
+            return "No handler calls yet."
+        return '\n'.join([
+            "{}: {}".format(key, stats.describe())
+            for key, stats in sorted(self.stats.items())
+        ])
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
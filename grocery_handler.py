@@ -42,6 +42,9 @@ class GroceryHandler(BaseHandler):
                     or any([l.startswith(prefix) for prefix in x['show_prefices']])
                     for x in self.lists])
 
+    def routing_prefixes(self):
+        return [prefix for x in self.lists for prefix in x['add_prefices'] + x['show_prefices']]
+
     def handle(self, message, **kwargs):
         db = kwargs['db']
         l = message.lower()
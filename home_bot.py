@@ -1,17 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import functools
 import threading
 
 import yaml
-import datetime
 import logging
 import asyncio
 
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
+from telegram import Message as TelegramMessage
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler
 from telegram.error import BadRequest
 import webserver
 import dataset
+import db_schema
 
 import inventory_handler
 import reminder_handler
@@ -29,6 +31,10 @@ import buttonhub_climate_handler
 import moat_cats_handler
 import list_preset_handler
 import wekan_handler
+from dispatcher import Dispatcher
+from media_cache import MediaCache, read_photo
+from router import CommandRouter
+from scheduler import PeriodicScheduler, Cron
 from service_hub import ServiceHub
 
 from utils import get_generic_response
@@ -65,6 +71,9 @@ class HomeBot:
         self.periodic_db = None
         self.config = None
         self.bot = None
+        self.dispatcher = None
+        self.router = None
+        self.media_cache = None
         self.exit = threading.Event()
         self.handlers = []
 
@@ -99,6 +108,20 @@ class HomeBot:
         future = asyncio.run_coroutine_threadsafe(self.send_message(message, **kwargs), self.loop)
         future.result()
 
+    def send_messages_from_thread(self, messages):
+        """
+        Sends (message, kwargs) pairs all at once and waits for all of them. Returns what each
+        send returned or raised, in order, so one failing recipient doesn't hold up the others.
+        """
+        async def send_all():
+            return await asyncio.gather(
+                *[self.send_message(message, **kwargs) for message, kwargs in messages],
+                return_exceptions=True,
+            )
+
+        future = asyncio.run_coroutine_threadsafe(send_all(), self.loop)
+        return future.result()
+
     def send_message_to_admins_from_thread(self, message):
         future = asyncio.run_coroutine_threadsafe(self.send_message_to_all_admins(message), self.loop)
         future.result()
@@ -113,32 +136,20 @@ class HomeBot:
                     raise ValueError("Using inline buttons requires you to pass a key")
                 buttons = self.assemble_inline_buttons(message['buttons'], key)
             if 'photo' in message:
+                await self.send_photo(message, buttons, recipient_id, update_message_id)
+            else:
                 if update_message_id is not None:
-                    await self.bot.edit_message_media(
-                        chat_id=recipient_id,
-                        message_id=update_message_id,
-                        reply_markup=buttons,
-                        media=InputMediaPhoto(
-                            open(message['photo'], 'rb'),
-                            caption=message.get('message'),
+                    try:
+                        await self.bot.edit_message_text(
+                            text=message['message'],
+                            reply_markup=buttons,
+                            chat_id=recipient_id,
+                            message_id=update_message_id,
                             parse_mode=message.get('parse_mode')
                         )
-                    )
-                else:  # new photo
-                    await self.bot.send_photo(recipient_id,
-                                        open(message['photo'], 'rb'),
-                                        caption=message.get('message'),
-                                        reply_markup=buttons,
-                                        parse_mode=message.get('parse_mode'))
-            else:
-                if update_message_id is not None:
-                    await self.bot.edit_message_text(
-                        text=message['message'],
-                        reply_markup=buttons,
-                        chat_id=recipient_id,
-                        message_id=update_message_id,
-                        parse_mode=message.get('parse_mode')
-                    )
+                    except BadRequest as err: # Ignore "message is not modified"
+                        if "Message is not modified" not in err.message:
+                            raise err
                 else:
                     await self.bot.send_message(recipient_id,
                                           message['message'],
@@ -146,14 +157,55 @@ class HomeBot:
                                           parse_mode=message.get('parse_mode'))
         else:
             if update_message_id is not None:
-                await self.bot.edit_message_text(
-                    text=message,
-                    chat_id=recipient_id,
-                    message_id=update_message_id
-                )
+                try:
+                    await self.bot.edit_message_text(
+                        text=message,
+                        chat_id=recipient_id,
+                        message_id=update_message_id
+                    )
+                except BadRequest as err: # Ignore "message is not modified"
+                    if "Message is not modified" not in err.message:
+                        raise err
             else:
                 await self.bot.send_message(recipient_id, message)
 
+    async def send_photo(self, message, buttons, recipient_id, update_message_id=None):
+        # Photos we uploaded before are sent by file_id instead of being uploaded again.
+        content = read_photo(message['photo'])
+        digest = self.media_cache.digest(content)
+        file_id = self.media_cache.get(digest)
+        if file_id is not None:
+            try:
+                await self._put_photo(file_id, message, buttons, recipient_id, update_message_id)
+                return
+            except BadRequest as err:
+                if "Message is not modified" in err.message:
+                    return
+                # most likely Telegram doesn't know this file_id anymore
+                logger.info("Cached photo was rejected, uploading it again: {}".format(err.message))
+                self.media_cache.forget(digest)
+        sent = await self._put_photo(content, message, buttons, recipient_id, update_message_id)
+        if isinstance(sent, TelegramMessage) and sent.photo:
+            self.media_cache.put(digest, sent.photo[-1].file_id)
+
+    async def _put_photo(self, photo, message, buttons, recipient_id, update_message_id):
+        if update_message_id is not None:
+            return await self.bot.edit_message_media(
+                chat_id=recipient_id,
+                message_id=update_message_id,
+                reply_markup=buttons,
+                media=InputMediaPhoto(
+                    photo,
+                    caption=message.get('message'),
+                    parse_mode=message.get('parse_mode')
+                )
+            )
+        return await self.bot.send_photo(recipient_id,
+                                         photo,
+                                         caption=message.get('message'),
+                                         reply_markup=buttons,
+                                         parse_mode=message.get('parse_mode'))
+
     async def send_message_to_all_admins(self, message):
         recipients = [self.config['owner_id']]
         for admin_id in self.config['admin_ids']:
@@ -169,14 +221,12 @@ class HomeBot:
             await update.message.reply_text("You're not my master. I won't talk to you!")
             return
 
-        matched_handler = None
-        for handler in self.handlers:
-            if update.message.text is not None and handler.matches_message(update.message.text):
-                matched_handler = handler
-                break
+        matched_handler = self.router.route(update.message.text)
 
         if matched_handler:
-            reply = matched_handler.handle(
+            reply = await self.dispatcher.run(
+                matched_handler,
+                matched_handler.handle,
                 update.message.text,
                 db=self.db,
                 message_id=update.message.message_id,
@@ -206,7 +256,9 @@ class HomeBot:
 
         for handler in self.handlers:
             if handler.key == key:
-                answer = handler.handle_button(
+                answer = await self.dispatcher.run(
+                    handler,
+                    handler.handle_button,
                     payload,
                     db=self.db,
                     message_id=query.message.message_id,
@@ -219,15 +271,11 @@ class HomeBot:
                         if answer.get('buttons'):
                             buttons = self.assemble_inline_buttons(answer['buttons'], key)
                         if 'photo' in answer:
-                            await context.bot.edit_message_media(
-                                chat_id=query.message.chat.id,
-                                message_id=query.message.message_id,
-                                reply_markup=buttons,
-                                media=InputMediaPhoto(
-                                    open(answer['photo'], 'rb'),
-                                    caption=answer.get('message', None),
-                                    parse_mode=answer.get('parse_mode')
-                                )
+                            await self.send_photo(
+                                answer,
+                                buttons,
+                                query.message.chat.id,
+                                update_message_id=query.message.message_id,
                             )
                         else:
                             try:
@@ -274,6 +322,36 @@ class HomeBot:
 
         await update.message.reply_text(helptext, parse_mode="Markdown")
 
+    # Stats command handler
+    async def handle_stats(self, update, context):
+        """Send handler latency stats when the command /stats is issued."""
+        permission = self.get_permissions(update.message.from_user.id)
+        if permission not in PERMISSIONS or permission < PERM_ADMIN:
+            await update.message.reply_text("You're not my master. I won't talk to you!")
+            return
+
+        stats = self.dispatcher.describe()
+        stats += "\n\nMedia cache: {} hits, {} misses".format(self.media_cache.hits, self.media_cache.misses)
+        for handler in self.handlers:
+            handler_stats = handler.stats()
+            if handler_stats:
+                stats += "\n{}: {}".format(handler.name, handler_stats)
+        await update.message.reply_text(stats)
+
+    # Route command handler
+    async def handle_route(self, update, context):
+        """Tell which handler would answer the text given to the command /route."""
+        permission = self.get_permissions(update.message.from_user.id)
+        if permission not in PERMISSIONS or permission < PERM_ADMIN:
+            await update.message.reply_text("You're not my master. I won't talk to you!")
+            return
+
+        text = " ".join(context.args)
+        if not text:
+            await update.message.reply_text("Usage: /route <message>")
+            return
+        await update.message.reply_text(self.router.explain(text))
+
     # Error handler
     async def handle_error(self, update, context):
         """Log Errors caused by Updates."""
@@ -288,6 +366,7 @@ class HomeBot:
 
         self.db = dataset.connect('sqlite:///{}'.format(config['db']))
         self.periodic_db = dataset.connect('sqlite:///{}'.format(config['db']))
+        db_schema.migrate(self.db)
         self.config = config
         if 'debug' not in config:
             config['debug'] = False
@@ -296,8 +375,12 @@ class HomeBot:
 
         """Start the bot."""
         # Create the EventHandler and pass it your bot's token.
-        app = Application.builder().token(config['token']).build()
+        self.dispatcher = Dispatcher(config)
+        # Updates are handled one at a time otherwise, and a slow handler would hold up everyone
+        # else's. As many at once as the dispatcher has workers, beyond that they'd only queue there.
+        app = Application.builder().token(config['token']).concurrent_updates(self.dispatcher.workers).build()
         self.bot = app.bot
+        self.media_cache = MediaCache(config)
 
         service_hub = ServiceHub(config)
 
@@ -305,11 +388,19 @@ class HomeBot:
         for handler_class in HANDLER_CLASSES:
             handler = handler_class(self.config, self, service_hub)
             self.handlers.append(handler)
+        self.router = CommandRouter(self.handlers)
+        service_hub.start()
 
-        t = threading.Thread(target=self.scheduler_run)
-        t.start()
+        scheduler = PeriodicScheduler(self.config, self.exit)
+        for handler in self.handlers:
+            schedule = handler.schedule()
+            if schedule is not None:
+                scheduler.add(handler.key, schedule, functools.partial(handler.run_periodically, self.periodic_db))
+        scheduler.add("wal_checkpoint", Cron(minute=0), self.wal_checkpoint)
 
         app.add_handler(CommandHandler("help", self.handle_help))
+        app.add_handler(CommandHandler("stats", self.handle_stats))
+        app.add_handler(CommandHandler("route", self.handle_route))
 
         app.add_error_handler(self.handle_error)
 
@@ -328,6 +419,12 @@ class HomeBot:
 
         self.loop = loop
 
+        for handler in self.handlers:
+            handler.setup(self.periodic_db)
+
+        t = threading.Thread(target=scheduler.run)
+        t.start()
+
         webserver.init(self.send_message_to_admins_from_thread, self.config)
         t2 = threading.Thread(target=webserver.run)
         t2.setDaemon(True)
@@ -337,34 +434,17 @@ class HomeBot:
 
 
         self.exit.set()
+        self.dispatcher.shutdown()
 
         for handler in self.handlers:
             handler.teardown()
+        service_hub.teardown()
 
-    def scheduler_run(self):
-        while not self.exit.is_set():
-            for handler in self.handlers:
-                try:
-                    handler.run_periodically(self.periodic_db)
-                except Exception as e:
-                    logger.error("Exception on scheduler thread with handler {}".format(handler.key))
-                    logger.exception(e)
-            if datetime.datetime.now().minute == 0:
-                try:
-                    r = self.periodic_db.query("PRAGMA main.wal_checkpoint(FULL);")
-                    if self.config['debug']:
-                        for row in r:
-                            logger.info("WAL checkpoint: busy flag {}, {} logged to WAL, {} checkpointed.".format(row['busy'], row['log'], row['checkpointed']))
-                except Exception as e:
-                    logger.error("Exception on scheduler thread during WAL checkpoint")
-                    logger.exception(e)
-            try:
-                self.exit.wait(60)
-            except Exception as e:
-                logger.error("Exception on scheduler thread")
-                logger.exception(e)
-        logger.info("Scheduler thread has exited")
-        logger.info("Exit signal is {}".format(self.exit.is_set()))
+    def wal_checkpoint(self):
+        r = self.periodic_db.query("PRAGMA main.wal_checkpoint(FULL);")
+        if self.config['debug']:
+            for row in r:
+                logger.info("WAL checkpoint: busy flag {}, {} logged to WAL, {} checkpointed.".format(row['busy'], row['log'], row['checkpointed']))
 
 
 def main(opts):
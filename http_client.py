@@ -0,0 +1,91 @@
+import asyncio
+import functools
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, MaxRetryError, NewConnectionError
+from urllib3.util.retry import Retry
+
+DEFAULT_TIMEOUT = 7
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 4
+DEFAULT_MAX_HOSTS = 16
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.3
+
+RETRY_STATUSES = (502, 503, 504)
+
+
+class _Retry(Retry):
+    # urllib3 counts connect timeouts as connection errors. A host that doesn't answer within the
+    # timeout won't answer on the next try either, so only refused or reset connections are retried.
+    # (NewConnectionError is a subclass of ConnectTimeoutError for historical reasons.)
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if isinstance(error, ConnectTimeoutError) and not isinstance(error, NewConnectionError):
+            raise MaxRetryError(_pool, url, error) from error
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+class HttpClient:
+    """
+    Keep-alive connection pool shared by all services and handlers.
+
+    Mirrors the requests API (get, post, request) and fills in a default timeout. Idempotent
+    requests are retried with backoff on refused or reset connections and gateway errors;
+    connect and read timeouts are not retried, so a slow or unreachable server costs at most
+    one timeout. Pass retry=False for requests that must not take longer than their timeout
+    at all. The *_async variants run the same pooled session in a worker thread.
+    """
+
+    def __init__(self, config):
+        http_config = config.get('http') or {}
+        self.timeout = http_config.get('timeout', DEFAULT_TIMEOUT)
+        retries = http_config.get('retries', DEFAULT_RETRIES)
+        retry = _Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            backoff_factor=http_config.get('backoff', DEFAULT_BACKOFF),
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS']),
+            raise_on_status=False,
+        )
+        self.session = self._session(http_config, retry)
+        self.session_without_retries = self._session(http_config, 0)
+
+    @staticmethod
+    def _session(http_config, retry):
+        adapter = HTTPAdapter(
+            pool_connections=http_config.get('max_hosts', DEFAULT_MAX_HOSTS),
+            pool_maxsize=http_config.get('max_connections_per_host', DEFAULT_MAX_CONNECTIONS_PER_HOST),
+            pool_block=True,
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def request(self, method, url, retry=True, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        session = self.session if retry else self.session_without_retries
+        return session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    async def request_async(self, method, url, **kwargs):
+        return await asyncio.to_thread(functools.partial(self.request, method, url, **kwargs))
+
+    async def get_async(self, url, **kwargs):
+        return await self.request_async('GET', url, **kwargs)
+
+    async def post_async(self, url, **kwargs):
+        return await self.request_async('POST', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+        self.session_without_retries.close()
@@ -28,6 +28,9 @@ class InventoryHandler(BaseHandler):
                or SEARCH_PATTERN.match(message) is not None \
                or LIST_PATTERN.match(message) is not None
 
+    def routing_prefixes(self):
+        return ['the', 'where', 'what']
+
     def handle(self, message, **kwargs):
         if kwargs['permission'] < PERM_ADMIN:
             return "Sorry, I won't tell you where anything is."
@@ -34,6 +34,11 @@ class ListPresetHandler(BaseHandler):
         l = message.lower().strip()
         return l == 'list preset'
 
+    def routing_prefixes(self):
+        if not self.enabled:
+            return []
+        return ['list preset']
+
     def handle(self, message, **kwargs):
         if kwargs['permission'] < PERM_ADMIN:
             return "You don't get to use the list presets."
@@ -0,0 +1,53 @@
+import collections
+import hashlib
+import threading
+
+DEFAULT_SIZE = 256
+
+
+def read_photo(photo):
+    # photos are either a path, raw bytes or a file-like object
+    if isinstance(photo, (bytes, bytearray)):
+        return bytes(photo)
+    if hasattr(photo, 'read'):
+        if hasattr(photo, 'seek'):
+            photo.seek(0)
+        return photo.read()
+    with open(photo, 'rb') as file:
+        return file.read()
+
+
+class MediaCache:
+    """Remembers the Telegram file_id of uploaded photos by content hash, least recently used first out."""
+
+    def __init__(self, config):
+        self.size = config.get('media_cache_size', DEFAULT_SIZE)
+        self._file_ids = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(content):
+        return hashlib.sha256(content).hexdigest()
+
+    def get(self, digest):
+        with self._lock:
+            file_id = self._file_ids.get(digest)
+            if file_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._file_ids.move_to_end(digest)
+            return file_id
+
+    def put(self, digest, file_id):
+        with self._lock:
+            self._file_ids[digest] = file_id
+            self._file_ids.move_to_end(digest)
+            while len(self._file_ids) > self.size:
+                self._file_ids.popitem(last=False)
+
+    def forget(self, digest):
+        with self._lock:
+            self._file_ids.pop(digest, None)
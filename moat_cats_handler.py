@@ -44,6 +44,11 @@ class MoatCatsHandler(BaseHandler):
             return
         return PATTERN.match(message) is not None
 
+    def routing_prefixes(self):
+        if not self.enabled:
+            return []
+        return ['have ', 'cat', 'do ', 'should ', 'is ', 'were ']
+
     def handle(self, message, **kwargs):
         if kwargs['permission'] < PERM_ADMIN:
             return "Sorry, you can't do this."
@@ -3,7 +3,8 @@ import requests
 
 class MoatService:
 
-    def __init__(self, config):
+    def __init__(self, config, http):
+        self.http = http
         if 'moat' in config:
             self.base_url = config['moat']['base_url']
             self.enabled = True
@@ -12,7 +13,7 @@ class MoatService:
 
     def get_cats_status(self):
         try:
-            response = requests.get(f'{self.base_url}/cats-status', timeout=5)
+            response = self.http.get(f'{self.base_url}/cats-status', timeout=5)
             response.raise_for_status()
             return response.json()
         except requests.HTTPError:
@@ -1,20 +1,49 @@
 from base_handler import *
+import concurrent.futures
+import logging
 import subprocess
 import json
+import threading
 import time
-import requests
 from utils import PERM_OWNER
+from scheduler import Interval
+
+logger = logging.getLogger(__name__)
 
 SHUT_DOWN = "bye"
 TURN_ON = "on"
 TURN_POWER_OFF = "off"
 REMOVE_BUTTONS = "rm"
 
+# seconds a probed on/powered state is shown without probing again
+DEFAULT_STATE_TTL = 60
+DEFAULT_REFRESH_INTERVAL = 30
+# one ssh connection is kept open and reused by all commands
+DEFAULT_CONTROL_PATH = "~/.ssh/homebot-%C"
+DEFAULT_CONTROL_PERSIST = 600
+DEFAULT_CONNECT_TIMEOUT = 5
+# seconds the status probes may take, a probe that takes longer is reported as unknown
+DEFAULT_SSH_DEADLINE = 10
+DEFAULT_RELAY_DEADLINE = 3
+ALIVE_MARKER = "love"
+
+def time_left(deadline):
+    if deadline is None:
+        return None
+    return max(0.1, deadline - time.monotonic())
+
+
 class PCHandler(BaseHandler):
     def __init__(self, config, messenger, service_hub):
         super().__init__(config, messenger, service_hub, key= "pc", name="Computer Control")
         if 'pc' in config:
             self.config = config['pc']
+            self.state_ttl = self.config.get('state_ttl', DEFAULT_STATE_TTL)
+            self._state = None
+            self._state_fetched_at = 0
+            self._state_invalidated_at = 0
+            self._state_lock = threading.Lock()
+            self.probe_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='pc')
             self.enabled = True
         else:
             self.enabled = False
@@ -24,6 +53,11 @@ class PCHandler(BaseHandler):
             return False
         return message.lower().startswith('pc')
 
+    def routing_prefixes(self):
+        if not self.enabled:
+            return []
+        return ['pc']
+
     def help(self, permission):
         if not self.enabled:
             return
@@ -33,13 +67,89 @@ class PCHandler(BaseHandler):
                 'examples': ["PC"],
             }
 
+    def teardown(self):
+        if self.enabled:
+            self.probe_pool.shutdown(wait=False, cancel_futures=True)
+
+    def schedule(self):
+        if not self.enabled:
+            return None
+        return Interval(self.config.get('refresh_interval', DEFAULT_REFRESH_INTERVAL))
+
+    def run_periodically(self, db):
+        # keeps the state fresh, so asking for it doesn't have to wait for ssh
+        self.get_state(refresh=True)
+
+    def get_state(self, refresh=False):
+        # Same idea as ButtonhubService.get_state: one probe at a time, shared for state_ttl seconds,
+        # and with refresh only a probe that started after the call is good enough.
+        requested_at = time.monotonic()
+        with self._state_lock:
+            if self._state is not None and self._state_fetched_at >= self._state_invalidated_at:
+                if refresh:
+                    fresh = self._state_fetched_at >= requested_at
+                else:
+                    fresh = requested_at - self._state_fetched_at < self.state_ttl
+                if fresh:
+                    return self._state
+            fetched_at = time.monotonic()
+            self._state = self.probe()
+            self._state_fetched_at = fetched_at
+            return self._state
+
+    def probe(self):
+        """
+        Asks the relay and the PC at the same time. A probe that fails or misses its deadline
+        leaves its part of the state at None, meaning unknown.
+        """
+        ssh_deadline = self.config.get('ssh_deadline', DEFAULT_SSH_DEADLINE)
+        relay_deadline = self.config.get('relay_deadline', DEFAULT_RELAY_DEADLINE)
+        started = time.monotonic()
+        ssh = self.probe_pool.submit(self.probe_ssh, ssh_deadline)
+        relay = self.probe_pool.submit(self.is_powered, relay_deadline)
+
+        def remaining(deadline):
+            # the timeouts passed to the probes only bound single steps, this bounds the whole probe
+            return max(0, started + deadline - time.monotonic())
+
+        state = {'on': None, 'powered': None, 'workspaces': None}
+        try:
+            state['on'], state['workspaces'] = ssh.result(timeout=remaining(ssh_deadline))
+        except concurrent.futures.TimeoutError:
+            logger.warning("Couldn't tell whether the PC is on: no answer within {}s".format(ssh_deadline))
+        except Exception as e:
+            logger.warning("Couldn't tell whether the PC is on: {}".format(e))
+        try:
+            state['powered'] = relay.result(timeout=remaining(relay_deadline))
+        except concurrent.futures.TimeoutError:
+            logger.warning("Couldn't tell whether the PC is powered: no answer within {}s".format(relay_deadline))
+        except Exception as e:
+            logger.warning("Couldn't tell whether the PC is powered: {}".format(e))
+        return state
+
+    def probe_ssh(self, timeout):
+        # liveness and workspaces in one go: the marker shows ssh got through, whatever the script does
+        status, out, err = self.run_command(
+            "echo {} && sudo ./getworkspaces".format(ALIVE_MARKER), timeout=timeout)
+        marker, _, workspaces = out.partition("\n")
+        if marker != ALIVE_MARKER:
+            return False, None
+        if status != 0:
+            return True, "Error when getting workspace info: \n{}".format(err)
+        return True, self.format_workspaces(workspaces)
+
+    def invalidate_state(self):
+        # a probe still in flight started before this and won't count as fresh anymore
+        self._state_invalidated_at = time.monotonic()
+
     def handle(self, message, **kwargs):
         if kwargs['permission'] != PERM_OWNER:
             return "Nuh-uh, you can't do this"
 
-        if self.is_on():
+        state = self.get_state()
+        if state['on']:
             return {
-                "message": "PC is on. \n\n{}".format(self.get_workspaces()),
+                "message": "PC is on. \n\n{}".format(state['workspaces']),
                 'buttons': [
                     [{
                         'text': "Shut it down!",
@@ -51,7 +161,21 @@ class PCHandler(BaseHandler):
                     }],
                 ],
             }
-        if self.is_powered():
+        if state['on'] is None:
+            return {
+                "message": self.unknown_message(state),
+                'buttons': [
+                    [{
+                        'text': "Boot it up",
+                        'data': "{}".format(TURN_ON)
+                    }],
+                    [{
+                        'text': "kthx",
+                        'data': "{}".format(REMOVE_BUTTONS)
+                    }],
+                ],
+            }
+        if state['powered']:
             return {
                 "message": "PC is off but powered",
                 'buttons': [
@@ -70,7 +194,7 @@ class PCHandler(BaseHandler):
                 ],
             }
         return {
-            "message": "PC is off",
+            "message": "PC is off" if state['powered'] is not None else "PC is off (the power switch didn't answer)",
             'buttons': [
                 [{
                     'text': "Boot it up",
@@ -91,24 +215,36 @@ class PCHandler(BaseHandler):
         cmd = data[0]
 
         if cmd == SHUT_DOWN:
-            return self.shut_down()
+            msg = self.shut_down()
+            self.invalidate_state()
+            return msg
         if cmd == TURN_POWER_OFF:
+            msg = self.turn_power_off()
+            self.invalidate_state()
             return {
-                "message": self.turn_power_off(),
+                "message": msg,
                 "answer": "Gotcha!",
             }
         if cmd == TURN_ON:
+            msg = self.turn_on()
+            self.invalidate_state()
             return {
-                "message": self.turn_on(),
+                "message": msg,
                 "answer": "Gotcha!",
             }
         if cmd == REMOVE_BUTTONS:
-            if self.is_on():
+            state = self.get_state()
+            if state['on']:
                 return {
-                    "message": "PC is on. \n\n{}".format(self.get_workspaces()),
+                    "message": "PC is on. \n\n{}".format(state['workspaces']),
                     "answer": "Gotcha!",
                 }
-            if self.is_powered():
+            if state['on'] is None:
+                return {
+                    "message": self.unknown_message(state),
+                    "answer": "Gotcha!",
+                }
+            if state['powered']:
                 return {
                     "message": "PC is off but powered",
                     "answer": "Gotcha!",
@@ -118,11 +254,12 @@ class PCHandler(BaseHandler):
                 "answer": "Gotcha!",
             }
 
-    def get_workspaces(self):
-        status, out, err = self.run_command("sudo ./getworkspaces")
-        if status != 0:
-            return "Error when getting workspace info: \n{}".format(err)
+    def unknown_message(self, state):
+        if state['powered'] is None:
+            return "Neither the PC nor its power switch answered in time."
+        return "The PC didn't answer in time, its power is {}.".format("on" if state['powered'] else "off")
 
+    def format_workspaces(self, out):
         tree = json.loads(out)
 
         monitors = [node for node in tree['nodes'] if not node['name'].startswith("__")]
@@ -174,7 +311,7 @@ class PCHandler(BaseHandler):
         if not force:
             if self.is_on():
                 return "Your PC is on. I won't cut power."
-        response = requests.get("{}/relay?state=0".format(self.config['switch_ip']))
+        response = self._http.get("{}/relay?state=0".format(self.config['switch_ip']))
         if response.status_code == 200:
             return "Alright, I turned off your PC's power."
         return "I wasn't able to turn off your PC's power, sorry :("
@@ -185,40 +322,76 @@ class PCHandler(BaseHandler):
                 return "Your PC is already on. I won't cycle power."
 
         if self.is_powered():
-            response = requests.get("{}/relay?state=0".format(self.config['switch_ip']))
+            response = self._http.get("{}/relay?state=0".format(self.config['switch_ip']))
             if response.status_code != 200:
                 return "I wasn't able to cycle power, sorry :("
             time.sleep(2)
 
-        response = requests.get("{}/relay?state=1".format(self.config['switch_ip']))
+        response = self._http.get("{}/relay?state=1".format(self.config['switch_ip']))
         if response.status_code != 200:
             return "I wasn't able to turn on your PC, sorry :("
         return "Your PC should now be turning on."
 
-    def is_powered(self):
-        status = json.loads(requests.get("{}/report".format(self.config['switch_ip'])).text)
+    def is_powered(self, timeout=None):
+        status = json.loads(self._http.get(
+            "{}/report".format(self.config['switch_ip']),
+            timeout=timeout or DEFAULT_RELAY_DEADLINE,
+            # a retry would run past the deadline, the next probe is soon enough
+            retry=False,
+        ).text)
         return status['relay']
 
     def is_on(self):
         status, out, err = self.run_command("echo love")
         return status == 0
 
-    def run_command(self, command):
+    def ensure_master(self, deadline=None):
+        # The master is started on its own with all output discarded: one that backgrounds
+        # itself from a command run with capture_output keeps the pipes open and hangs the call.
+        check = subprocess.run(
+            self.gen_ssh("-O check"), capture_output=True, shell=True, timeout=time_left(deadline))
+        if check.returncode == 0:
+            return True
+        started = subprocess.run(
+            self.gen_ssh("-f -N -o ControlMaster=yes -o ControlPersist={}".format(
+                self.config.get('control_persist', DEFAULT_CONTROL_PERSIST))),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            shell=True,
+            timeout=time_left(deadline),
+        )
+        return started.returncode == 0
+
+    def run_command(self, command, timeout=None):
+        # timeout covers connecting and running the command together, every step gets what's left of it
+        deadline = time.monotonic() + timeout if timeout else None
+        if not self.ensure_master(deadline):
+            # no need to wait for a second connect timeout
+            return 255, "", "Couldn't connect to {}".format(self.config['host'])
+        timeout = time_left(deadline)
         cmd = self.gen_command(command)
         process = subprocess.run(
             cmd,
             capture_output=True,
-            shell=True
+            shell=True,
+            timeout=timeout
         )
         out = process.stdout
         err = process.stderr
         status = process.returncode
         return status, out.decode('UTF-8'), err.decode('UTF-8')
 
-    def gen_command(self, command):
-        return "ssh {}@{} -i {} '{}'".format(
+    def gen_ssh(self, options):
+        return "ssh {}@{} -i {} -o BatchMode=yes -o ConnectTimeout={} -o ControlPath={} {}".format(
             self.config['user'],
             self.config['host'],
             self.config['keyfile'],
-            command
+            self.config.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT),
+            self.config.get('control_path', DEFAULT_CONTROL_PATH),
+            options,
         )
+
+    def gen_command(self, command):
+        # should the master have gone away in the meantime, ssh connects on its own
+        return "{} '{}'".format(self.gen_ssh("-o ControlMaster=no"), command)
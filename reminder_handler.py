@@ -3,6 +3,8 @@ import re
 import parsedatetime
 import datetime
 import logging
+from db_schema import REMINDERS, from_epoch
+from timer_queue import TimerQueue
 from utils import get_affirmation
 from wekan_service import WekanService
 
@@ -62,6 +64,22 @@ class ReminderHandler(BaseHandler):
     def __init__(self, config, messenger, service_hub):
         super().__init__(config, messenger, service_hub, key="rem", name="Reminders")
         self.wekan_service = service_hub.wekan
+        self.db = None
+        self.queue = TimerQueue("reminders", self.send_reminder)
+
+    def setup(self, db):
+        # Only needed to pick up where we left off after a restart, everything after that
+        # goes through the queue. Overdue reminders come out of the queue right away.
+        self.db = db
+        count = 0
+        for reminder in db.query('SELECT id, next_ts FROM reminders WHERE active = 1'):
+            self.queue.schedule(reminder['id'], from_epoch(reminder['next_ts']))
+            count += 1
+        logger.info("Scheduled {} active reminders".format(count))
+        self.queue.start()
+
+    def teardown(self):
+        self.queue.stop()
 
     def help(self, permission):
         return {
@@ -79,6 +97,9 @@ class ReminderHandler(BaseHandler):
     def matches_message(self, message):
         return PATTERN.match(message) is not None
 
+    def routing_prefixes(self):
+        return ['rem']
+
     def handle(self, message, **kwargs):
         db = kwargs['db']
         actor_id = kwargs['actor_id']
@@ -115,7 +136,8 @@ class ReminderHandler(BaseHandler):
 
         if isinstance(reminder, dict):
             table = db['reminders']
-            reminder_id = table.insert(reminder)
+            reminder_id = table.insert(REMINDERS.dump(reminder))
+            self.queue.schedule(reminder_id, reminder['next'])
             return {
                 'message': msg.format(
                     reminder['next'].strftime("%A, %B %-d %Y at %-H:%M")
@@ -141,10 +163,11 @@ class ReminderHandler(BaseHandler):
         method = parts[1]
 
         table = db['reminders']
-        reminder = table.find_one(id=reminder_id)
+        reminder = REMINDERS.load(table.find_one(id=reminder_id))
         answer = {}
         if method == REMOVE_REMINDER:
             table.delete(id=reminder_id)
+            self.queue.cancel(reminder_id)
             answer = {
                 'answer': "Reminder deleted",
                 'delete': True,
@@ -174,6 +197,7 @@ class ReminderHandler(BaseHandler):
             }
         if method == REMOVE_PERIODIC_REMINDER:
             table.delete(id=reminder_id)
+            self.queue.cancel(reminder_id)
             answer = {
                 'answer': "Reminder deleted",
                 'message': "{}\n\nThis periodic reminder was deleted.".format(self.reminder_to_string(reminder)),
@@ -189,9 +213,10 @@ class ReminderHandler(BaseHandler):
             reminder['active'] = True
 
             if 'id' in reminder:
-                table.update(reminder, ['id'])
+                table.update(REMINDERS.dump(reminder), ['id'])
+                self.queue.schedule(reminder['id'], reminder['next'])
             else:
-                table.insert(reminder)
+                self.queue.schedule(table.insert(REMINDERS.dump(reminder)), reminder['next'])
 
             answer = {
                 'answer': "Reminder snoozed for {}".format(amount),
@@ -426,74 +451,74 @@ class ReminderHandler(BaseHandler):
             " {}".format(reminder['separator']),
             reminder['subject'])
 
-    def run_periodically(self, db):
+    def send_reminder(self, reminder_id):
         debug = self._debug
-        table = db['reminders']
+        table = self.db['reminders']
         send = self._messenger.send_message_from_thread
-        now = datetime.datetime.now()
-        if debug:
-            logger.info("Querying reminders for {}...".format(now))
 
-        reminders = db.query('SELECT * FROM reminders WHERE active IS TRUE AND next < :now', now=now)
-
-        count = 0
-        for reminder in reminders:
-            # this is so stupid I can't even
-            # dataset returns dates as string but only accepts them as datetime
-            reminder['next'] = datetime.datetime.strptime(reminder['next'], '%Y-%m-%d %H:%M:%S.%f')
-
-            count += 1
-            if debug:
-                logger.info("Sending reminder {} ({})".format(count, reminder['subject']))
-
-            msg = self.reminder_to_string(reminder)
-
-            buttons = [
-                [{
-                    'text': 'Got it!',
-                    'data': '{}:{}'.format(reminder['id'], REMOVE_BUTTONS),
-                }],
-            ]
+        reminder = REMINDERS.load(table.find_one(id=reminder_id))
+        if not reminder or not reminder['active']:
+            return
+        if reminder['next'] > datetime.datetime.now():
+            # moved since it was queued
+            self.queue.schedule(reminder_id, reminder['next'])
+            return
 
-            if 'actor' in reminder and self.wekan_service.can_create_cards(reminder['actor']):
-                buttons[0].append(
-                    {
-                        'text': 'Create card',
-                        'data': '{}:{}'.format(reminder['id'], CREATE_CARD),
-                    },
-                )
+        if debug:
+            logger.info("Sending reminder {} ({})".format(reminder_id, reminder['subject']))
 
-            if reminder['periodic']:
-                self.advance_periodic_reminder(reminder)
-                buttons.append(
-                    [{
-                        'text': "Remove this reminder",
-                        'data': '{}:{}'.format(reminder['id'], REMOVE_PERIODIC_REMINDER),
-                    }],
-                )
-            else:
-                reminder['active'] = False
+        msg = self.reminder_to_string(reminder)
 
-            buttons.append([
-                {
-                    'text': snooze['button'],
-                    'data': '{}:{}'.format(reminder['id'], snooze_type),
-                } for snooze_type, snooze in SNOOZE_REMINDERS.items()
-            ])
+        buttons = [
+            [{
+                'text': 'Got it!',
+                'data': '{}:{}'.format(reminder['id'], REMOVE_BUTTONS),
+            }],
+        ]
 
-            send(
+        if 'actor' in reminder and self.wekan_service.can_create_cards(reminder['actor']):
+            buttons[0].append(
                 {
-                  'message': msg,
-                    'buttons': buttons,
+                    'text': 'Create card',
+                    'data': '{}:{}'.format(reminder['id'], CREATE_CARD),
                 },
-                key=self.key,
-                recipient_id=reminder['actor'] if 'actor' in reminder else None,
             )
 
-            if debug:
-                logger.info("Updating reminder {}".format(count))
-            table.update(reminder, ['id'])
-            if debug:
-                logger.info("Finished reminder {}".format(count))
+        if reminder['periodic']:
+            # after downtime, skip the occurrences we missed instead of sending them one by one
+            now = datetime.datetime.now()
+            self.advance_periodic_reminder(reminder)
+            while reminder['next'] <= now:
+                self.advance_periodic_reminder(reminder)
+            buttons.append(
+                [{
+                    'text': "Remove this reminder",
+                    'data': '{}:{}'.format(reminder['id'], REMOVE_PERIODIC_REMINDER),
+                }],
+            )
+        else:
+            reminder['active'] = False
+
+        buttons.append([
+            {
+                'text': snooze['button'],
+                'data': '{}:{}'.format(reminder['id'], snooze_type),
+            } for snooze_type, snooze in SNOOZE_REMINDERS.items()
+        ])
+
+        send(
+            {
+              'message': msg,
+                'buttons': buttons,
+            },
+            key=self.key,
+            recipient_id=reminder['actor'] if 'actor' in reminder else None,
+        )
+
+        if debug:
+            logger.info("Updating reminder {}".format(reminder_id))
+        table.update(REMINDERS.dump(reminder), ['id'])
+        if reminder['active']:
+            self.queue.schedule(reminder_id, reminder['next'])
         if debug:
-            logger.info("Sent out {} reminders".format(count))
+            logger.info("Finished reminder {}".format(reminder_id))
@@ -0,0 +1,79 @@
+class _TrieNode:
+    __slots__ = ('children', 'handlers')
+
+    def __init__(self):
+        self.children = {}
+        self.handlers = set()
+
+
+class _Trie:
+    def __init__(self):
+        self.root = _TrieNode()
+
+    def add(self, word, handler_index):
+        node = self.root
+        for char in word:
+            node = node.children.setdefault(char, _TrieNode())
+        node.handlers.add(handler_index)
+
+    def collect(self, text, into):
+        node = self.root
+        into.update(node.handlers)
+        for char in text:
+            node = node.children.get(char)
+            if node is None:
+                return
+            into.update(node.handlers)
+
+
+class CommandRouter:
+    """
+    Only asks the handlers whose declared prefixes/suffixes fit the message (plus the ones that
+    declared none) whether they match, in their original order, so the first match still wins.
+    """
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.prefixes = _Trie()
+        self.suffixes = _Trie()
+        self.unindexed = set()
+
+        for index, handler in enumerate(handlers):
+            prefixes = handler.routing_prefixes()
+            suffixes = handler.routing_suffixes()
+            if prefixes is None and suffixes is None:
+                self.unindexed.add(index)
+                continue
+            for prefix in prefixes or []:
+                self.prefixes.add(prefix.lower(), index)
+            for suffix in suffixes or []:
+                self.suffixes.add(suffix.lower()[::-1], index)
+
+    def candidates(self, message):
+        text = message.lower()
+        indices = set(self.unindexed)
+        self.prefixes.collect(text.lstrip(), indices)
+        self.suffixes.collect(text.rstrip()[::-1], indices)
+        return [self.handlers[i] for i in sorted(indices)]
+
+    def route(self, message):
+        if message is None:
+            return None
+        for handler in self.candidates(message):
+            if handler.matches_message(message):
+                return handler
+        return None
+
+    def explain(self, message):
+        candidates = self.candidates(message)
+        winner = None
+        for handler in candidates:
+            if handler.matches_message(message):
+                winner = handler
+                break
+        lines = [
+            "Winner: {}".format("{} ({})".format(winner.name, winner.key) if winner else "none"),
+            "Candidates: {}".format(", ".join([h.key for h in candidates]) or "none"),
+            "Always checked: {}".format(", ".join([self.handlers[i].key for i in sorted(self.unindexed)]) or "none"),
+        ]
+        return '\n'.join(lines)
@@ -0,0 +1,130 @@
+import concurrent.futures
+import datetime
+import heapq
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+DEFAULT_DRIFT_WARNING = 10
+
+
+class Interval:
+    def __init__(self, seconds):
+        self.delta = datetime.timedelta(seconds=seconds)
+
+    def first(self, now):
+        return now
+
+    def next_after(self, scheduled, now):
+        next_run = scheduled + self.delta
+        if next_run <= now:
+            # we fell behind, don't try to catch up on the ticks we missed
+            next_run = now + self.delta
+        return next_run
+
+
+class Cron:
+    """Runs on every minute matching all given fields. A field is an int, a collection of ints or None for any."""
+
+    def __init__(self, minute=None, hour=None, days=None):
+        self.minute = self._to_set(minute)
+        self.hour = self._to_set(hour)
+        self.days = self._to_set(days)
+
+    @staticmethod
+    def _to_set(field):
+        if field is None:
+            return None
+        if isinstance(field, int):
+            return {field}
+        return set(field)
+
+    def first(self, now):
+        return self._next_match(now.replace(second=0, microsecond=0))
+
+    def next_after(self, scheduled, now):
+        return self._next_match(max(scheduled, now).replace(second=0, microsecond=0) + datetime.timedelta(minutes=1))
+
+    def _next_match(self, dt):
+        while True:
+            if self.days is not None and dt.day not in self.days:
+                dt = (dt + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+                continue
+            if self.hour is not None and dt.hour not in self.hour:
+                dt = (dt + datetime.timedelta(hours=1)).replace(minute=0)
+                continue
+            if self.minute is not None and dt.minute not in self.minute:
+                dt += datetime.timedelta(minutes=1)
+                continue
+            return dt
+
+
+class _Job:
+    def __init__(self, name, schedule, func):
+        self.name = name
+        self.schedule = schedule
+        self.func = func
+        self.future = None
+
+
+class PeriodicScheduler:
+    """
+    Runs jobs on their own schedules in a worker pool. A job whose previous run has not finished
+    yet is skipped for that tick rather than run twice at the same time.
+    """
+
+    def __init__(self, config, exit_event):
+        scheduler_config = config.get('scheduler') or {}
+        self.debug = config['debug']
+        self.drift_warning = scheduler_config.get('drift_warning', DEFAULT_DRIFT_WARNING)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=scheduler_config.get('workers', DEFAULT_WORKERS),
+            thread_name_prefix='periodic',
+        )
+        self.exit = exit_event
+        self.jobs = []
+
+    def add(self, name, schedule, func):
+        self.jobs.append(_Job(name, schedule, func))
+
+    def run(self):
+        counter = itertools.count()
+        queue = []
+        now = datetime.datetime.now()
+        for job in self.jobs:
+            heapq.heappush(queue, (job.schedule.first(now), next(counter), job))
+            logger.info("Scheduled {}".format(job.name))
+
+        while queue and not self.exit.is_set():
+            scheduled, _, job = queue[0]
+            delay = (scheduled - datetime.datetime.now()).total_seconds()
+            if delay > 0:
+                self.exit.wait(delay)
+                continue
+            heapq.heappop(queue)
+
+            if job.future is not None and not job.future.done():
+                logger.warning("Skipping {} at {}, its previous run is still going".format(job.name, scheduled))
+            else:
+                job.future = self.executor.submit(self._run_job, job, scheduled)
+
+            heapq.heappush(queue, (job.schedule.next_after(scheduled, datetime.datetime.now()), next(counter), job))
+
+        self.executor.shutdown(wait=True)
+        logger.info("Scheduler thread has exited")
+        logger.info("Exit signal is {}".format(self.exit.is_set()))
+
+    def _run_job(self, job, scheduled):
+        started = datetime.datetime.now()
+        drift = (started - scheduled).total_seconds()
+        if drift >= self.drift_warning:
+            logger.warning("{} started {:.1f} s late".format(job.name, drift))
+        elif self.debug:
+            logger.info("{} started {:.3f} s late".format(job.name, drift))
+        try:
+            job.func()
+        except Exception as e:
+            logger.error("Exception on scheduler thread with {}".format(job.name))
+            logger.exception(e)
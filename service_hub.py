@@ -1,10 +1,20 @@
 from buttonhub_service import ButtonhubService
+from http_client import HttpClient
 from moat_service import MoatService
 from wekan_service import WekanService
 
 
 class ServiceHub:
     def __init__(self, config):
-        self.wekan = WekanService(config)
-        self.buttonhub = ButtonhubService(config)
-        self.moat = MoatService(config)
+        self.http = HttpClient(config)
+        self.wekan = WekanService(config, self.http)
+        self.buttonhub = ButtonhubService(config, self.http)
+        self.moat = MoatService(config, self.http)
+
+    def start(self):
+        self.buttonhub.start()
+
+    def teardown(self):
+        self.buttonhub.teardown()
+        self.http.close()
+
@@ -0,0 +1,100 @@
+import datetime
+import heapq
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Never sleep longer than this, so a changed wall clock is noticed eventually.
+MAX_WAIT = 300
+# A key whose callback raised is tried again after RETRY_DELAY seconds, doubling with every
+# failure in a row up to MAX_RETRY_DELAY.
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 3600
+
+
+class TimerQueue:
+    """
+    Calls callback(key) on its own thread once the time scheduled for key has come. If the
+    callback raises, the key is scheduled again with a backoff, unless the callback already did.
+    """
+
+    def __init__(self, name, callback):
+        self.name = name
+        self.callback = callback
+        self._heap = []
+        self._scheduled = {}
+        self._failures = {}
+        self._condition = threading.Condition()
+        self._exit = False
+        self._thread = None
+
+    def schedule(self, key, when):
+        with self._condition:
+            self._scheduled[key] = when
+            heapq.heappush(self._heap, (when, key))
+            self._condition.notify()
+
+    def cancel(self, key):
+        # the heap entry stays behind and is skipped once it comes up
+        with self._condition:
+            self._scheduled.pop(key, None)
+
+    def next_due(self):
+        with self._condition:
+            self._drop_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._exit = True
+            self._condition.notify()
+
+    def _drop_stale(self):
+        while self._heap and self._scheduled.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def _next(self):
+        with self._condition:
+            while not self._exit:
+                self._drop_stale()
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                when, key = self._heap[0]
+                delay = (when - datetime.datetime.now()).total_seconds()
+                if delay <= 0:
+                    heapq.heappop(self._heap)
+                    del self._scheduled[key]
+                    return key
+                self._condition.wait(min(delay, MAX_WAIT))
+        return None
+
+    def _retry(self, key):
+        failures = self._failures.get(key, 0) + 1
+        self._failures[key] = failures
+        delay = min(RETRY_DELAY * 2 ** (failures - 1), MAX_RETRY_DELAY)
+        with self._condition:
+            if key in self._scheduled:
+                return
+            logger.info("Trying {} in timer queue {} again in {}s".format(key, self.name, delay))
+            self.schedule(key, datetime.datetime.now() + datetime.timedelta(seconds=delay))
+
+    def _run(self):
+        while True:
+            key = self._next()
+            if key is None:
+                break
+            try:
+                self.callback(key)
+            except Exception as e:
+                logger.error("Exception in timer queue {} for {}".format(self.name, key))
+                logger.exception(e)
+                self._retry(key)
+            else:
+                self._failures.pop(key, None)
+        logger.info("Timer queue {} has exited".format(self.name))
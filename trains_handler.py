@@ -1,10 +1,18 @@
 from base_handler import *
 
+import concurrent.futures
 import datetime
+import hashlib
 import logging
 import json
-import requests
 import re
+import threading
+import time
+
+from unicodedata import normalize
+
+from db_schema import TRAIN_AUTO_REFRESH, to_epoch
+from scheduler import Interval
 
 logger = logging.getLogger(__name__)
 
@@ -45,6 +53,23 @@ WALK_EMOJI = u"\U0001F9B6\U0001F3FB"
 
 LIMIT = 5
 
+DEFAULT_FETCH_WORKERS = 4
+# seconds for all lookups and stationboards of one message together
+DEFAULT_DEADLINE = 10
+REQUEST_TIMEOUT = 7
+# seconds a resolved station name is trusted
+DEFAULT_STATION_TTL = 30 * 24 * 3600
+
+# seconds a fetched list of connections is reused
+DEFAULT_CONNECTION_TTL = 60
+# hours during which the favourite routes are kept in the connection cache
+DEFAULT_COMMUTE_HOURS = [6, 7, 8, 16, 17, 18]
+
+# seconds after which a realtime departure table is fetched again even if it has enough departures left
+DEFAULT_REALTIME_MAX_AGE = 300
+
+UMLAUTS = str.maketrans({'ä': 'ae', 'ö': 'oe', 'ü': 'ue'})
+
 REFRESH_STATIONBOARD = "ref"
 REFRESH_CONNECTIONS = "rec"
 INVERSE_CONNECTIONS = "inv"
@@ -52,10 +77,89 @@ AUTO_REFRESH_STATIONBOARD = "arc"
 AUTO_REFRESH_CONNECTIONS = "ars"
 STOP_AUTO_REFRESH = "sar"
 
+class ConnectionEntry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = None
+        self.fetched_at = 0
+
+
+class ConnectionCache:
+    """
+    Connections per (from, to), reused for ttl seconds. Concurrent askers for the same key wait
+    for the first one's fetch.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.entries_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def entry(self, key):
+        with self.entries_lock:
+            if key not in self.entries:
+                # expired entries would be fetched again anyway, those still being fetched are kept
+                now = time.monotonic()
+                self.entries = {k: e for k, e in self.entries.items()
+                                if e.data is None or now - e.fetched_at < self.ttl}
+                self.entries[key] = ConnectionEntry()
+            return self.entries[key]
+
+    def get(self, key, fetch):
+        entry = self.entry(key)
+        with entry.lock:
+            if entry.data is None or time.monotonic() - entry.fetched_at >= self.ttl:
+                self.misses += 1
+                entry.data = fetch()
+                entry.fetched_at = time.monotonic()
+            else:
+                self.hits += 1
+            return entry.data
+
+    def describe(self):
+        return "connections {} hits, {} misses".format(self.hits, self.misses)
+
+
+class DepartureBoard:
+    def __init__(self, station_name, departures):
+        self.station_name = station_name
+        self.departures = departures
+        self.fetched_at = time.monotonic()
+
+    def upcoming(self, types, after, realtime):
+        field = 'expected' if realtime else 'scheduled'
+        return sorted((departure for departure in self.departures
+                       if (types is None or departure['category'] in types) and departure[field] > after),
+                      key=lambda departure: departure[field])
+
+
 class TrainsHandler(BaseHandler):
     def __init__(self, config, messenger, service_hub):
         super().__init__(config, messenger, service_hub, key="zvv", name="Train connections")
         self.config = config['trains']
+        self.deadline = self.config.get('deadline', DEFAULT_DEADLINE)
+        self.station_ttl = self.config.get('station_ttl', DEFAULT_STATION_TTL)
+        self.connections = ConnectionCache(self.config.get('connection_ttl', DEFAULT_CONNECTION_TTL))
+        self.commute_hours = set(self.config.get('commute_hours', DEFAULT_COMMUTE_HOURS))
+        self.favourite_routes = self.config.get('favourite_routes') or []
+        # In realtime mode countdowns use the prognosis and departure tables are kept around,
+        # so refreshing a stationboard only calls the API once the table runs low or gets old.
+        self.realtime = self.config.get('realtime', False)
+        self.realtime_max_age = self.config.get('realtime_max_age', DEFAULT_REALTIME_MAX_AGE)
+        self.boards = {}
+        self.boards_lock = threading.Lock()
+        self.fetch_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.config.get('fetch_workers', DEFAULT_FETCH_WORKERS),
+            thread_name_prefix='trains',
+        )
+
+    def teardown(self):
+        self.fetch_pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return self.connections.describe()
 
     def help(self, permission):
         return {
@@ -72,17 +176,21 @@ class TrainsHandler(BaseHandler):
         return NEXT_REGEX.match(message) is not None \
             or NEXT_FROM_REGEX.match(message) is not None
 
+    def routing_prefixes(self):
+        return ['next', 'train', 'tram', 'bus', 'conn']
+
     def handle(self, message, **kwargs):
+        db = kwargs['db']
         matches = NEXT_FROM_TO_REGEX.match(message)
         if matches:
             groups = matches.groups()
             from_query = groups[1]
             to_query = groups[2]
-            return self.find_connection(from_query, to_query)
+            return self.find_connection(db, from_query, to_query, prefetch=True)
 
         matches = NEXT_FROM_REGEX.match(message)
         if matches:
-            return self.find_stationboards(matches)
+            return self.find_stationboards(db, matches)
 
         matches = NEXT_REGEX.match(message)
         if matches:
@@ -110,14 +218,14 @@ class TrainsHandler(BaseHandler):
             more_parts = payload.split(':')
             from_station = more_parts[0]
             to_station = more_parts[1]
-            msg = self.find_connection(from_station, to_station)
+            msg = self.find_connection(db, from_station, to_station, prefetch=True)
             msg['answer'] = "Refreshed!"
             return msg
         if cmd == INVERSE_CONNECTIONS:
             more_parts = payload.split(':')
             from_station = more_parts[0]
             to_station = more_parts[1]
-            msg = self.find_connection(to_station, from_station)
+            msg = self.find_connection(db, to_station, from_station, prefetch=True)
             msg['answer'] = "Inverted!"
             return msg
         if cmd == AUTO_REFRESH_STATIONBOARD:
@@ -131,8 +239,9 @@ class TrainsHandler(BaseHandler):
                 'until': datetime.datetime.now() + datetime.timedelta(minutes=15),
                 'actor': actor_id,
             }
-            auto_refreshes.insert(auto_refresh)
             msg = self.stationboard_message(stations, types, stop_auto_refresh=True)
+            auto_refresh['last_hash'] = self.rendered_hash(msg)
+            auto_refreshes.insert(TRAIN_AUTO_REFRESH.dump(auto_refresh))
             msg['answer'] = "Auto-refresh enabled!"
             return msg
         if cmd == AUTO_REFRESH_CONNECTIONS:
@@ -146,23 +255,28 @@ class TrainsHandler(BaseHandler):
                 'until': datetime.datetime.now() + datetime.timedelta(minutes=15),
                 'actor': actor_id,
             }
-            auto_refreshes.insert(auto_refresh)
-            msg = self.find_connection(from_station, to_station, stop_auto_refresh=True)
+            msg = self.find_connection(db, from_station, to_station, stop_auto_refresh=True, prefetch=True)
+            auto_refresh['last_hash'] = self.rendered_hash(msg)
+            auto_refreshes.insert(TRAIN_AUTO_REFRESH.dump(auto_refresh))
             msg['answer'] = "Auto-refresh enabled!"
             return msg
         if cmd == STOP_AUTO_REFRESH:
             auto_refresh = auto_refreshes.find_one(message=message_id)
             if not auto_refresh:
                 return "Oh damn, this shouldn't happen!"
-            msg = self.get_auto_refresh_message(auto_refresh, False)
+            msg = self.get_auto_refresh_message(db, auto_refresh, False)
             auto_refreshes.delete(id=auto_refresh['id'])
             msg['answer'] = "Auto-refresh stopped!"
             return msg
 
         return "Oh, looks like something went wrong..."
 
-    def find_connection(self, from_query, to_query, stop_auto_refresh=False):
-        connections = json.loads(requests.get(CONNECTION_URL, params={'from': from_query, 'to': to_query}, timeout=7).text)
+    def find_connection(self, db, from_query, to_query, stop_auto_refresh=False, prefetch=False):
+        # unresolvable names are passed on as they are, the connections API can still try its luck
+        resolved = self.resolve_stations(db, [from_query, to_query], time.monotonic() + self.deadline)
+        from_query = resolved.get(from_query, from_query)
+        to_query = resolved.get(to_query, to_query)
+        connections = self.fetch_connections(from_query, to_query)
 
         next_minute = (datetime.datetime.now() + datetime.timedelta(minutes=1)).timestamp()
 
@@ -211,6 +325,9 @@ class TrainsHandler(BaseHandler):
 
         if msg == "":
             return "Oh no, there don't seem to be any connections between these stations. Do they really exist?"
+        if prefetch:
+            # so that pressing Invert doesn't have to wait for the API
+            self.fetch_pool.submit(self.prefetch_connections, to_id, from_id)
         return {
             'message': msg,
             'parse_mode': 'markdown',
@@ -231,22 +348,149 @@ class TrainsHandler(BaseHandler):
 
         }
 
-    def find_stationboards(self, matches):
+    def fetch_connections(self, from_id, to_id, timeout=REQUEST_TIMEOUT):
+        return self.connections.get((from_id, to_id), lambda: json.loads(self._http.get(
+            CONNECTION_URL, params={'from': from_id, 'to': to_id}, timeout=timeout).text))
+
+    def prefetch_connections(self, from_id, to_id):
+        try:
+            self.fetch_connections(from_id, to_id)
+        except Exception as e:
+            logger.warning("Couldn't prefetch connections from {} to {}: {}".format(from_id, to_id, e))
+
+    def warm_favourite_routes(self, db):
+        deadline = time.monotonic() + self.deadline
+        queries = [query for route in self.favourite_routes for query in (route['from'], route['to'])]
+        resolved = self.resolve_stations(db, queries, deadline)
+        routes = [(resolved[route['from']], resolved[route['to']]) for route in self.favourite_routes
+                  if route['from'] in resolved and route['to'] in resolved]
+        self.fetch_all(lambda route, timeout: self.fetch_connections(*route, timeout=timeout), routes, deadline)
+
+    def find_stationboards(self, db, matches):
         groups = matches.groups()
         types = self.keyword_to_type(groups[0])
         search_queries = re.split(r'\s*,\s*|\s*and\s*', groups[1])
 
-        stations = []
-        for query in search_queries:
-            locations = json.loads(requests.get(LOCATION_URL, params={'query': query}, timeout=7).text)
-            if locations['stations']:
-                station = locations['stations'][0]['id']
-                if station:
-                    stations.append(station)
+        deadline = time.monotonic() + self.deadline
+        resolved = self.resolve_stations(db, search_queries, deadline)
+        stations = [resolved[query] for query in search_queries if query in resolved]
 
         if not stations:
             return "No stations found by that name :("
-        return self.stationboard_message(stations, types)
+        return self.stationboard_message(stations, types, deadline=deadline)
+
+    @staticmethod
+    def normalize_station(query):
+        query = " ".join(query.lower().translate(UMLAUTS).split())
+        return normalize('NFD', query).encode('ascii', 'ignore').decode('ascii')
+
+    def resolve_stations(self, db, queries, deadline):
+        """
+        Maps station names to station ids, asking the locations API only for names that aren't
+        in the train_stations table yet or have been there for longer than station_ttl.
+        Names that can't be resolved are left out.
+        """
+        resolved = {}
+        misses = []
+        cutoff = to_epoch(datetime.datetime.now()) - self.station_ttl
+        table = db['train_stations']
+        for query in queries:
+            if query.isdigit():
+                # already a station id, e.g. from a button
+                resolved[query] = query
+                continue
+            cached = table.find_one(query_norm=self.normalize_station(query))
+            if cached and cached['fetched_ts'] >= cutoff:
+                resolved[query] = cached['station_id']
+            elif query not in misses:
+                misses.append(query)
+
+        for query, station in self.fetch_all(self.find_station, misses, deadline):
+            if not station:
+                continue
+            resolved[query] = station
+            table.upsert({
+                'query_norm': self.normalize_station(query),
+                'station_id': station,
+                'fetched_ts': to_epoch(datetime.datetime.now()),
+            }, ['query_norm'])
+        return resolved
+
+    def find_station(self, query, timeout):
+        locations = json.loads(self._http.get(LOCATION_URL, params={'query': query}, timeout=timeout).text)
+        if locations['stations']:
+            return query, locations['stations'][0]['id']
+        return query, None
+
+    def fetch_stationboard(self, station, timeout):
+        stationboard = json.loads(self._http.get(STATIONBOARD_URL.format(station), timeout=timeout).text)
+        departures = [self.parse_departure(connection) for connection in stationboard['stationboard']]
+        return station, DepartureBoard(stationboard['station']['name'], departures)
+
+    @staticmethod
+    def parse_departure(connection):
+        stop = connection['stop']
+        scheduled = stop['departureTimestamp']
+        delay = stop.get('delay') or 0
+        expected = scheduled + delay * 60
+        prognosis = (stop.get('prognosis') or {}).get('departure')
+        if prognosis:
+            try:
+                expected = datetime.datetime.strptime(prognosis, "%Y-%m-%dT%H:%M:%S%z").timestamp()
+                delay = int(expected - scheduled) // 60
+            except ValueError:
+                pass
+        return {
+            'category': connection['category'],
+            'number': connection['number'],
+            'to': connection['to'],
+            'scheduled': scheduled,
+            'expected': expected,
+            'delay': delay,
+        }
+
+    def get_boards(self, stations, types, deadline):
+        if not self.realtime:
+            return [board for _, board in self.fetch_all(self.fetch_stationboard, stations, deadline)]
+
+        next_minute = (datetime.datetime.now() + datetime.timedelta(minutes=1)).timestamp()
+        with self.boards_lock:
+            stale = [station for station in stations
+                     if station not in self.boards
+                     or time.monotonic() - self.boards[station].fetched_at >= self.realtime_max_age
+                     or len(self.boards[station].upcoming(types, next_minute, True)) < LIMIT]
+        fetched = self.fetch_all(self.fetch_stationboard, stale, deadline)
+        with self.boards_lock:
+            self.boards.update(fetched)
+            # boards of other stations that are too old to be shown without fetching them again go,
+            # so the table only holds stations asked for lately
+            now = time.monotonic()
+            self.boards = {station: board for station, board in self.boards.items()
+                           if station in stations or now - board.fetched_at < self.realtime_max_age}
+            # a station that couldn't be fetched is shown from its old table, if there is one
+            return [self.boards[station] for station in stations if station in self.boards]
+
+    def fetch_all(self, fetch, items, deadline):
+        """
+        Calls fetch(item, timeout) for all items at once. Results come back in the order of items;
+        items that failed or didn't make it before the deadline are left out.
+        """
+        def run(item):
+            return fetch(item, max(0.1, min(REQUEST_TIMEOUT, deadline - time.monotonic())))
+
+        futures = [self.fetch_pool.submit(run, item) for item in items]
+        concurrent.futures.wait(futures, timeout=max(0, deadline - time.monotonic()))
+
+        results = []
+        for item, future in zip(items, futures):
+            if not future.done():
+                future.cancel()
+                logger.warning("Dropping {}, it didn't make the deadline".format(item))
+            elif future.exception() is not None:
+                logger.warning("Dropping {}: {}".format(item, future.exception()))
+            else:
+                results.append(future.result())
+        return results
 
     def keyword_to_type(self, keyword):
         if keyword.startswith("tram"):
@@ -255,34 +499,31 @@ class TrainsHandler(BaseHandler):
             return [BUS]
         return None
 
-    def stationboard_message(self, stations, types=None, stop_auto_refresh=False):
-        stationboards = []
-
-        for station in stations:
-            station_url = STATIONBOARD_URL.format(station)
-            stationboard = json.loads(requests.get(station_url, timeout=7).text)
-            stationboards.append(stationboard)
-
-        for stationboard in stationboards:
-            next_minute = (datetime.datetime.now() + datetime.timedelta(minutes=1)).timestamp()
-            stationboard['stationboard'] = [connection for connection in stationboard['stationboard']
-                                            if (types is None or connection['category'] in types)
-                                            and connection['stop']['departureTimestamp'] > next_minute][:LIMIT]
+    def stationboard_message(self, stations, types=None, stop_auto_refresh=False, deadline=None):
+        if deadline is None:
+            deadline = time.monotonic() + self.deadline
+        stationboards = self.get_boards(stations, types, deadline)
 
         message = ""
 
         now = datetime.datetime.now().timestamp()
+        next_minute = (datetime.datetime.now() + datetime.timedelta(minutes=1)).timestamp()
+        field = 'expected' if self.realtime else 'scheduled'
         for stationboard in stationboards:
-            message += "Connections from {}:\n".format(stationboard['station']['name'])
-            for connection in stationboard['stationboard']:
-                message += "{} {} {}   {}'\n".format(
-                    EMOJI[connection['category']] if connection['category'] in EMOJI else DEFAULT_EMOJI,
-                    connection['number'],
-                    connection['to'],
-                    int((connection['stop']['departureTimestamp'] - now) // 60)
+            message += "Connections from {}:\n".format(stationboard.station_name)
+            for departure in stationboard.upcoming(types, next_minute, self.realtime)[:LIMIT]:
+                message += "{} {} {}   {}'{}\n".format(
+                    EMOJI[departure['category']] if departure['category'] in EMOJI else DEFAULT_EMOJI,
+                    departure['number'],
+                    departure['to'],
+                    int((departure[field] - now) // 60),
+                    " (+{})".format(departure['delay']) if self.realtime and departure['delay'] > 0 else "",
                 )
             message += "\n"
 
+        if not stationboards:
+            message = "Couldn't load the stationboards in time, try refreshing."
+
         stations_str = ",".join([str(s) for s in stations])
         types_str = ",".join(types) if types else ""
         return {
@@ -301,30 +542,85 @@ class TrainsHandler(BaseHandler):
             }]]
         }
 
+    def schedule(self):
+        return Interval(60)
+
     def run_periodically(self, db):
         table = db['train_auto_refresh']
-        auto_refreshes = table.all()
-        for auto_refresh in auto_refreshes:
-            if self._debug:
-                logger.info("Auto-Refreshing message {}".format(auto_refresh['message']))
-            continue_refreshing = auto_refresh['until'] > datetime.datetime.now()
-            msg = self.get_auto_refresh_message(auto_refresh, continue_refreshing)
+        now = datetime.datetime.now()
+
+        if self.favourite_routes and now.hour in self.commute_hours:
+            self.warm_favourite_routes(db)
+
+        # rows showing the same thing are fetched and rendered once per tick
+        groups = {}
+        expired = []
+        for row in table.all():
+            auto_refresh = TRAIN_AUTO_REFRESH.load(row)
+            continue_refreshing = auto_refresh['until'] > now
             if not continue_refreshing:
-                if self._debug:
-                    logger.info("Removing auto-refresh for message {}".format(auto_refresh['message']))
-                table.delete(id=auto_refresh['id'])
-            self._messenger.send_message_from_thread(
-                msg,
-                update_message_id=auto_refresh['message'],
-                key=self.key,
-                recipient_id=auto_refresh['actor'] if 'actor' in auto_refresh else None,
+                expired.append(auto_refresh['id'])
+            group = (
+                auto_refresh.get('from_station'),
+                auto_refresh.get('to_station'),
+                auto_refresh.get('stations'),
+                auto_refresh.get('types'),
+                continue_refreshing,
             )
+            groups.setdefault(group, []).append(auto_refresh)
 
+        if expired:
+            if self._debug:
+                logger.info("Removing {} expired auto-refreshes".format(len(expired)))
+            table.delete(id=expired)
+
+        edits = []
+        edited = []
+        for group, auto_refreshes in groups.items():
+            try:
+                msg = self.get_auto_refresh_message(db, auto_refreshes[0], group[-1])
+            except Exception as e:
+                logger.error("Couldn't auto-refresh {}".format(group))
+                logger.exception(e)
+                continue
+            rendered_hash = self.rendered_hash(msg)
+            for auto_refresh in auto_refreshes:
+                if auto_refresh.get('last_hash') == rendered_hash:
+                    # the message already shows exactly this
+                    continue
+                if self._debug:
+                    logger.info("Auto-Refreshing message {}".format(auto_refresh['message']))
+                edits.append((msg, {
+                    'update_message_id': auto_refresh['message'],
+                    'key': self.key,
+                    'recipient_id': auto_refresh.get('actor'),
+                }))
+                edited.append((auto_refresh, rendered_hash))
+
+        if not edits:
+            return
+        results = self._messenger.send_messages_from_thread(edits)
+        for (auto_refresh, rendered_hash), result in zip(edited, results):
+            if isinstance(result, Exception):
+                logger.warning("Couldn't edit message {}: {}".format(auto_refresh['message'], result))
+            elif auto_refresh['id'] not in expired:
+                table.update({'id': auto_refresh['id'], 'last_hash': rendered_hash}, ['id'])
+
+    @staticmethod
+    def rendered_hash(msg):
+        # button data carries a timestamp and changes every time, the labels don't
+        if isinstance(msg, dict):
+            labels = [button['text'] for row in msg.get('buttons', []) for button in row]
+            content = json.dumps([msg.get('message'), labels])
+        else:
+            content = json.dumps(msg)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
 
-    def get_auto_refresh_message(self, auto_refresh, continue_refreshing=True):
+    def get_auto_refresh_message(self, db, auto_refresh, continue_refreshing=True):
         msg = {}
         if 'from_station' in auto_refresh and auto_refresh['from_station'] is not None:
             msg = self.find_connection(
+                db,
                 auto_refresh['from_station'],
                 auto_refresh['to_station'],
                 stop_auto_refresh=continue_refreshing,
@@ -1,13 +1,18 @@
 from base_handler import *
 
+import concurrent.futures
 import datetime
+import multiprocessing
 import logging
 import json
-import requests
+import threading
+import time
 
 from unicodedata import normalize
 
 import weather_plotter
+from db_schema import to_epoch
+from scheduler import Interval
 
 logger = logging.getLogger(__name__)
 
@@ -24,13 +29,111 @@ METEO_API_HEADERS = {"referer": "https://www.meteoswiss.admin.ch/home.html?tab=o
 METEO_LANGUAGE_CODE = '1'
 
 REFRESH = "ref"
+REFRESH_TEXT = "reft"
+
+# Plots are rendered on the calling thread unless this is set, generate_plot doesn't leak anymore.
+DEFAULT_PLOT_PROCESSES = 0
+DEFAULT_VERSIONS_TTL = 60
+DEFAULT_MAX_AGE = 3 * 3600
+DEFAULT_PREFETCH_INTERVAL = 60
+
+
+class ForecastEntry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = None
+        self.plots = {}
+
+
+class ForecastCache:
+    """
+    Forecasts and rendered plots per (forecast version, zip). Entries of older versions are
+    dropped as soon as MeteoSwiss publishes a new one.
+    """
+
+    def __init__(self, versions_ttl, max_age):
+        self.versions_ttl = versions_ttl
+        self.max_age = max_age
+        self.version = None
+        self.version_fetched_at = 0
+        self.version_lock = threading.Lock()
+        self.entries = {}
+        self.entries_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.plot_hits = 0
+        self.plot_misses = 0
+
+    def get_version(self, fetch, refresh=False):
+        with self.version_lock:
+            now = time.monotonic()
+            if self.version is None or refresh or now - self.version_fetched_at >= self.versions_ttl:
+                version = fetch()
+                self.version_fetched_at = now
+                if version != self.version:
+                    self.version = version
+                    with self.entries_lock:
+                        self.entries = {key: entry for key, entry in self.entries.items() if key[0] == version}
+            return self.version
+
+    def entry(self, version, zip):
+        with self.entries_lock:
+            key = (version, zip)
+            if key not in self.entries:
+                self.entries[key] = ForecastEntry()
+            return self.entries[key]
+
+    def describe(self):
+        return "forecasts {} hits, {} misses; plots {} hits, {} misses".format(
+            self.hits, self.misses, self.plot_hits, self.plot_misses)
 
 
 class WeatherHandler(BaseHandler):
     def __init__(self, config, messenger, service_hub):
         super().__init__(config, messenger, service_hub, key="wth", name="Weather Forecast")
         self.config = config['weather']
-
+        self.location_lock = threading.Lock()
+        self.forecasts = ForecastCache(
+            self.config.get('versions_ttl', DEFAULT_VERSIONS_TTL),
+            self.config.get('max_age', DEFAULT_MAX_AGE),
+        )
+        self.prefetched_version = None
+        self.push_time = None
+        if self.config.get('push_time'):
+            self.push_time = datetime.datetime.strptime(self.config['push_time'], "%H:%M").time()
+        self.plot_processes = self.config.get('plot_processes', DEFAULT_PLOT_PROCESSES)
+        self.plot_pool = self.make_plot_pool() if self.plot_processes else None
+        self.plot_pool_lock = threading.Lock()
+
+    def make_plot_pool(self):
+        # spawn rather than fork, the bot is full of threads by the time the first plot is made
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.plot_processes,
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+
+    def teardown(self):
+        if self.plot_pool is not None:
+            self.plot_pool.shutdown(wait=False, cancel_futures=True)
+
+    def render_plot(self, forecast, starttime=None):
+        pool = self.plot_pool
+        if pool is None:
+            return weather_plotter.generate_plot(forecast, starttime)
+        try:
+            return pool.submit(weather_plotter.generate_plot, forecast, starttime).result()
+        except concurrent.futures.BrokenExecutor as e:
+            # A killed worker (e.g. by the OOM killer) breaks the pool for good. Start a new one for
+            # the next plots and draw this one here.
+            logger.warning("Plot process pool broke, starting a new one: {}".format(e))
+            with self.plot_pool_lock:
+                if self.plot_pool is pool:
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    self.plot_pool = self.make_plot_pool()
+            return weather_plotter.generate_plot(forecast, starttime)
+
+    def stats(self):
+        return self.forecasts.describe()
 
     def help(self, permission):
         return {
@@ -38,64 +141,156 @@ class WeatherHandler(BaseHandler):
             'examples': [
                 "Weather",
                 "Weather tomorrow",
+                "Weather text",
                 "Weather in Appenzell",
+                "Weather subscribe",
             ],
         }
 
+    def schedule(self):
+        return Interval(self.config.get('prefetch_interval', DEFAULT_PREFETCH_INTERVAL))
+
+    def run_periodically(self, db):
+        # Warm the cache with the plots most people ask for as soon as a new version is out,
+        # then push the morning forecast to whoever subscribed to it.
+        zip = self.config['zip']
+        version = self.forecasts.get_version(self.fetch_version)
+        if version != self.prefetched_version:
+            if self._debug:
+                logger.info("Pre-rendering weather for forecast version {}".format(version))
+            self.get_plot(zip)
+            self.get_plot(zip, self.tomorrow_starttime())
+            self.prefetched_version = version
+
+        if self.push_time is None:
+            return
+        now = datetime.datetime.now()
+        if now.time() < self.push_time:
+            return
+        today = now.strftime("%Y-%m-%d")
+        table = db['weather_subscriptions']
+        for subscription in db.query('SELECT * FROM weather_subscriptions WHERE last_push IS NULL OR last_push < :today', today=today):
+            # mark it first, so one failing recipient doesn't get retried every minute
+            table.update({'id': subscription['id'], 'last_push': today}, ['id'])
+            try:
+                self._messenger.send_message_from_thread(
+                    self.get_weather_data(zip, self.config['city'], False),
+                    key=self.key,
+                    recipient_id=subscription['actor'],
+                )
+            except Exception as e:
+                logger.error("Failed to push weather to {}".format(subscription['actor']))
+                logger.exception(e)
+
+    def set_subscription(self, db, actor, subscribe):
+        if self.push_time is None:
+            return "Sorry, there is no daily weather forecast to subscribe to."
+        table = db['weather_subscriptions']
+        subscription = table.find_one(actor=actor)
+        if not subscribe:
+            if subscription:
+                table.delete(id=subscription['id'])
+            return "You will no longer receive the daily weather forecast."
+        if not subscription:
+            table.insert({
+                'actor': actor,
+                # don't push today if today's forecast time has already passed
+                'last_push': datetime.datetime.now().strftime("%Y-%m-%d")
+                if datetime.datetime.now().time() >= self.push_time else None,
+            })
+        return "You will receive the weather forecast every day at {}.".format(self.push_time.strftime("%-H:%M"))
+
     def matches_message(self, message):
         return message.lower().startswith("weather")
 
+    def routing_prefixes(self):
+        return ['weather']
+
     def handle(self, message, **kwargs):
         zip = self.config['zip']
         city_name = self.config['city']
 
+        command = message.lower().strip()
+        if command in ("weather subscribe", "weather unsubscribe"):
+            return self.set_subscription(kwargs['db'], kwargs['actor_id'], command == "weather subscribe")
+
         words = message.split()
+        text_only = "text" in [w.lower() for w in words]
+        words = [w for w in words if w.lower() != "text"]
         if "in" in words:
             location_words = words[words.index("in") + 1:]
             if location_words:
                 location = " ".join(location_words).lower().strip()
-                firstletters = self.de_unicodize(location)[:2]
-                search_results = json.loads(requests.get(
-                    METEO_SEARCH_URL.format(firstletters),
-                    headers=METEO_API_HEADERS,
-                    timeout=7
-                ).text)
-
-                cities = []
-                for r in search_results:
-                    parts = r.split(";")
-                    city = {
-                        'zip': parts[0],
-                        'canton': parts[1],
-                        'name': self.find_name(parts),
-                    }
-                    cities.append(city)
-
-                matches = []
-                for city in cities:
-                    if location in city['name'].lower():
-                        matches.append(city)
-                best_match = {}
-                shortest_len = 1000
-                for city in matches:
-                    if len(city['name']) < shortest_len:
-                        best_match = city
-                        shortest_len = len(city['name'])
-
-                if not best_match:
-                    matches = cities
-                    longest_len = 0
-                    for city in matches:
-                        if len(city['name']) > longest_len:
-                            best_match = city
-                            longest_len = len(city['name'])
-
+                best_match = self.find_location(kwargs['db'], location)
                 if best_match:
                     zip = best_match['zip']
                     city_name = "{} {}".format(best_match['name'], best_match['canton'])
 
+        if text_only:
+            return self.get_weather_summary(zip, city_name, "tomorrow" in message)
         return self.get_weather_data(zip, city_name, "tomorrow" in message)
 
+    def find_location(self, db, location):
+        # Towns are looked up in a local index of MeteoSwiss' search files, which are only
+        # downloaded the first time somebody asks for a town starting with the same two letters.
+        query = self.de_unicodize(location)
+        prefix = query[:2]
+        if not prefix:
+            return None
+        self.index_location_prefix(db, prefix)
+
+        upper = query[:-1] + chr(ord(query[-1]) + 1)
+        found = db.query(
+            'SELECT zip, canton, name FROM weather_locations '
+            'WHERE name_norm >= :query AND name_norm < :upper ORDER BY length(name), id LIMIT 1',
+            query=query, upper=upper,
+        )
+        for city in found:
+            return city
+        found = db.query(
+            'SELECT zip, canton, name FROM weather_locations '
+            'WHERE prefix = :prefix AND instr(name_norm, :query) > 0 ORDER BY length(name), id LIMIT 1',
+            prefix=prefix, query=query,
+        )
+        for city in found:
+            return city
+        found = db.query(
+            'SELECT zip, canton, name FROM weather_locations '
+            'WHERE prefix = :prefix ORDER BY length(name) DESC, id LIMIT 1',
+            prefix=prefix,
+        )
+        for city in found:
+            return city
+        return None
+
+    def index_location_prefix(self, db, prefix):
+        with self.location_lock:
+            prefixes = db['weather_location_prefixes']
+            if prefixes.find_one(prefix=prefix):
+                return
+            search_results = json.loads(self._http.get(
+                METEO_SEARCH_URL.format(prefix),
+                headers=METEO_API_HEADERS,
+                timeout=7
+            ).text)
+
+            cities = []
+            for r in search_results:
+                parts = r.split(";")
+                try:
+                    name = self.find_name(parts)
+                except (ValueError, IndexError):
+                    continue
+                cities.append({
+                    'prefix': prefix,
+                    'zip': parts[0],
+                    'canton': parts[1],
+                    'name': name,
+                    'name_norm': self.de_unicodize(name),
+                })
+            db['weather_locations'].insert_many(cities)
+            prefixes.insert({'prefix': prefix, 'fetched_ts': to_epoch(datetime.datetime.now())})
+
     def find_name(self, meteo_city_parts):
         return meteo_city_parts[meteo_city_parts.index(METEO_LANGUAGE_CODE) + 1]
 
@@ -108,29 +303,82 @@ class WeatherHandler(BaseHandler):
             msg = self.get_weather_data(parts[0], parts[1], parts[2].lower() == "true")
             msg['answer'] = "Refreshed!"
             return msg
+        if cmd == REFRESH_TEXT:
+            msg = self.get_weather_summary(parts[0], parts[1], parts[2].lower() == "true")
+            if isinstance(msg, dict):
+                msg['answer'] = "Refreshed!"
+            return msg
         return "Oh, something went wrong."
 
-    def get_weather_data(self, zip, city_name, for_tomorrow):
-        result = requests.get(METEO_VERSIONS_URL, timeout=7).json()
-
-        version_timestamp = result["forecast-chart"]
-
-        json_url = METEO_FORECAST_URL.format(version_timestamp, zip)
-
-        weather_data = json.loads(requests.get(
-            json_url, headers=METEO_API_HEADERS, timeout=7).text)
+    def fetch_version(self):
+        result = self._http.get(METEO_VERSIONS_URL, timeout=7).json()
+        return result["forecast-chart"]
+
+    def _load_forecast(self, version_timestamp, zip):
+        entry = self.forecasts.entry(version_timestamp, zip)
+        with entry.lock:
+            if entry.data is None:
+                self.forecasts.misses += 1
+                json_url = METEO_FORECAST_URL.format(version_timestamp, zip)
+                entry.data = weather_plotter.parse_forecast(json.loads(self._http.get(
+                    json_url, headers=METEO_API_HEADERS, timeout=7).text))
+            else:
+                self.forecasts.hits += 1
+        return entry
+
+    def is_outdated(self, forecast):
+        # A version's json never changes, so its own current_time tells how old it is.
+        return time.time() - forecast.now >= self.forecasts.max_age
+
+    def _forecast_entry(self, zip):
+        version_timestamp = self.forecasts.get_version(self.fetch_version)
+        entry = self._load_forecast(version_timestamp, zip)
+        if self.is_outdated(entry.data):
+            # maybe MeteoSwiss published in the meantime
+            refreshed = self.forecasts.get_version(self.fetch_version, refresh=True)
+            if refreshed != version_timestamp:
+                entry = self._load_forecast(refreshed, zip)
+        return entry
+
+    def get_forecast(self, zip):
+        forecast = self._forecast_entry(zip).data
+        if self.is_outdated(forecast):
+            # still the newest there is, but its "now" is long gone
+            forecast = forecast._replace(now=time.time())
+        return forecast
+
+    def get_plot(self, zip, starttime=None):
+        # Everyone asking for the same town and time span while the forecast version stays the
+        # same gets the same plot; the lock makes concurrent askers wait for the first one.
+        entry = self._forecast_entry(zip)
+        with entry.lock:
+            if starttime is None and self.is_outdated(entry.data):
+                # MeteoSwiss hasn't published for max_age: the cached plot starts and marks "now"
+                # hours ago, so draw the next hours from the old forecast instead
+                logger.warning("Newest forecast for {} is from {}".format(
+                    zip, datetime.datetime.fromtimestamp(entry.data.now)))
+                self.forecasts.plot_misses += 1
+                return self.render_plot(entry.data._replace(now=time.time()), starttime)
+
+            if starttime not in entry.plots:
+                self.forecasts.plot_misses += 1
+                entry.plots[starttime] = self.render_plot(entry.data, starttime)
+            else:
+                self.forecasts.plot_hits += 1
+            return entry.plots[starttime]
+
+    @staticmethod
+    def tomorrow_starttime():
+        tomorrow = datetime.datetime.now() + datetime.timedelta(days=1)
+        tomorrow_morning = datetime.datetime(year=tomorrow.year,
+                                             month=tomorrow.month,
+                                             day=tomorrow.day,
+                                             hour=5)
+        return tomorrow_morning.timestamp()
 
-        if for_tomorrow:
-            tomorrow = datetime.datetime.now() + datetime.timedelta(days=1)
-            tomorrow_morning = datetime.datetime(year=tomorrow.year,
-                                                 month=tomorrow.month,
-                                                 day=tomorrow.day,
-                                                 hour=5)
-            starttime = tomorrow_morning.timestamp()
-            plot, start, end = weather_plotter.generate_plot(weather_data, starttime)
-
-        else:
-            plot, start, end = weather_plotter.generate_plot(weather_data)
+    def get_weather_data(self, zip, city_name, for_tomorrow):
+        starttime = self.tomorrow_starttime() if for_tomorrow else None
+        plot, start, end = self.get_plot(zip, starttime)
 
         start_time = datetime.datetime.fromtimestamp(start)
         end_time = datetime.datetime.fromtimestamp(end)
@@ -148,5 +396,29 @@ class WeatherHandler(BaseHandler):
             }]]
         }
 
+    def get_weather_summary(self, zip, city_name, for_tomorrow):
+        starttime = self.tomorrow_starttime() if for_tomorrow else None
+        summary = weather_plotter.summarize(self.get_forecast(zip), starttime)
+        if summary is None:
+            return "There's no forecast for {} at that time.".format(city_name)
+
+        start_time = datetime.datetime.fromtimestamp(summary['start'])
+        end_time = datetime.datetime.fromtimestamp(summary['end'])
+
+        return {
+            'message': "Weather in {} from {} to {}:\n{:.0f} to {:.0f}°C, {:.1f} mm of rain".format(
+                city_name,
+                start_time.strftime("%A, %B %-d at %-H:%M"),
+                end_time.strftime("%A, %B %-d at %-H:%M"),
+                summary['min_temp'],
+                summary['max_temp'],
+                summary['rain'],
+            ),
+            'buttons': [[{
+                'text': "Refresh",
+                'data': "{}:{}:{}:{}:{}".format(REFRESH_TEXT, zip, city_name, for_tomorrow, datetime.datetime.now().timestamp())
+            }]]
+        }
+
     def de_unicodize(self, string):
         return normalize('NFD', string.lower()).encode('ascii', 'ignore').decode('ascii')
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
+import io
 import matplotlib
 matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import itertools
+from matplotlib.figure import Figure
 import datetime as dt
+from typing import NamedTuple
+import numpy as np
 from matplotlib import ticker
 # Map between Meteoswiss icon IDs and ConkyWeather font letters
 # To update the map, pull something like:
@@ -131,40 +133,85 @@ def format_time(time, pos=None):
     return dt.datetime.fromtimestamp(time).strftime('%H:%M')
 
 
-def generate_plot(weather_data, starttime=None):
-    j = weather_data
+# one row per hour of the forecast
+SERIES_DTYPE = np.dtype([('time', 'i8'), ('temp', 'f8'), ('rain', 'f8')])
 
-    # Extract the temperatures, precipitations and timestamps for the first few days in the json file.
-    temps = [ row[1]           for k in [0, 1, 2] for row in j[k].get("temperature") ]
-    precs = [ row[1]           for k in [0, 1, 2] for row in j[k].get("rainfall")    ]
-    times = [ int(row[0]/1000) for k in [0, 1, 2] for row in j[k].get("temperature") ]
 
-    # Extract icon information
-    icons = [ {"time":row.get("timestamp")/1000, "icon":weathericons.get(row.get("weather_symbol_id"), default_icon)} for k in [0,1,2] for row in j[k].get("symbols") ]
+class Forecast(NamedTuple):
+    series: np.ndarray      # SERIES_DTYPE, sorted by time
+    icon_times: np.ndarray  # seconds
+    icons: np.ndarray       # ConkyWeather letters
+    now: float              # current time as reported by the json, in seconds
 
-    # current time as reported by json, in seconds
-    now = j[0].get("current_time") / 1000
 
+def _rows(days, field):
+    rows = [row for day in days for row in day.get(field)]
+    return np.asarray(rows, dtype=float).reshape(len(rows), -1)
+
+
+def parse_forecast(weather_data):
+    # The first few days in the json file are all we ever show.
+    days = weather_data[:3]
+    temperature = _rows(days, "temperature")
+    rainfall = _rows(days, "rainfall")
+    length = min(len(temperature), len(rainfall))
+
+    series = np.empty(length, dtype=SERIES_DTYPE)
+    series['time'] = temperature[:length, 0] // 1000
+    series['temp'] = temperature[:length, 1]
+    series['rain'] = rainfall[:length, 1]
+
+    symbols = [row for day in days for row in day.get("symbols")]
+    icon_times = np.array([row.get("timestamp") for row in symbols], dtype=float) / 1000
+    icons = np.array([weathericons.get(row.get("weather_symbol_id"), default_icon) for row in symbols], dtype=object)
+
+    return Forecast(series, icon_times, icons, weather_data[0].get("current_time") / 1000)
+
+
+def window(forecast, starttime=None):
     # timespan to display
     if not starttime:
-        starttime = now - 3600
+        starttime = forecast.now - 3600
     endtime = starttime + 25 * 3600
 
-    # filter the temps, precs and times array such that only values within the timespan are included
-    indices = [starttime < x < endtime for x in times]
-    temps = list(itertools.compress(temps, indices))
-    precs = list(itertools.compress(precs, indices))
-    times = list(itertools.compress(times, indices))
+    # only values strictly within the timespan are included
+    times = forecast.series['time']
+    first = np.searchsorted(times, starttime, side='right')
+    last = np.searchsorted(times, endtime, side='left')
+    return forecast.series[first:last], starttime, endtime
+
+
+def summarize(forecast, starttime=None):
+    series, starttime, endtime = window(forecast, starttime)
+    if not len(series):
+        return None
+    return {
+        'min_temp': float(np.nanmin(series['temp'])),
+        'max_temp': float(np.nanmax(series['temp'])),
+        'rain': float(np.nansum(series['rain'])),
+        'start': starttime,
+        'end': endtime,
+    }
+
+
+def generate_plot(forecast, starttime=None):
+    series, starttime, endtime = window(forecast, starttime)
+    times = series['time']
+    temps = series['temp']
+    precs = series['rain']
+    now = forecast.now
 
     # where ticks on the x axis should go
     xticks = times[2::3]
 
     # max and min temperature, for adjusting the y axis range
-    maxtemp = max(temps)
-    mintemp = min(temps)
+    maxtemp = np.nanmax(temps)
+    mintemp = np.nanmin(temps)
 
-    # Set up plot
-    fig, ax1 = plt.subplots(figsize=(6, 3))
+    # Set up plot. Figures made this way are not registered with pyplot, so they are simply
+    # garbage collected once we're done with them, and concurrent renders don't share state.
+    fig = Figure(figsize=(6, 3))
+    ax1 = fig.subplots()
     for tl in ax1.get_xticklabels():
         tl.set_color('w')  # set all x tick labels to white
     ax1.xaxis.set_major_formatter(ticker.FuncFormatter(format_time))  # make the x axis convert unix timestamps to time strings
@@ -172,7 +219,7 @@ def generate_plot(weather_data, starttime=None):
     ax1.spines['top'].set_visible(False)  # remove top border
 
     # Plot precipitation
-    ax1.bar([x-1750 for x in times], precs, 3500, color='#aaaaff')
+    ax1.bar(times - 1750, precs, 3500, color='#aaaaff')
     ax1.set_ylim([0, 8])  # y axis range hardcoded to 0-8, that's usually fine
     ax1.set_facecolor('k')
 
@@ -181,9 +228,9 @@ def generate_plot(weather_data, starttime=None):
         tl.set_color('w')
 
     # Plot weather icons
-    for icon in icons:
-        if starttime < icon["time"] < endtime:
-            ax1.text(icon["time"] - 1800, 7.5, icon["icon"], color='w', fontname="ConkyWeather", fontstyle='oblique', fontsize=20)
+    visible = (forecast.icon_times > starttime) & (forecast.icon_times < endtime)
+    for icon_time, icon in zip(forecast.icon_times[visible], forecast.icons[visible]):
+        ax1.text(icon_time - 1800, 7.5, icon, color='w', fontname="ConkyWeather", fontstyle='oblique', fontsize=20)
 
     # Add new y axis and plot temperature
     ax2 = ax1.twinx()
@@ -198,6 +245,7 @@ def generate_plot(weather_data, starttime=None):
     for tl in ax2.get_yticklabels():
         tl.set_color('w')
 
-    # save figure to file
-    fig.savefig('/tmp/weather.png', facecolor='k', edgecolor='none', transparent=True, bbox_inches='tight', dpi=100)
-    return '/tmp/weather.png', starttime, endtime
+    # render figure to PNG in memory
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', facecolor='k', edgecolor='none', transparent=True, bbox_inches='tight', dpi=100)
+    return buffer.getvalue(), starttime, endtime
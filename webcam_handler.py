@@ -1,46 +1,180 @@
 from base_handler import *
+import concurrent.futures
+import io
+import logging
+import math
+import threading
+import time
+import numpy as np
 import requests
 from utils import PERM_ADMIN, get_timestamp
 from utils import get_exclamation
 from PIL import Image
+from scheduler import Interval
+
+logger = logging.getLogger(__name__)
 
 UPDATE = 'UP'
+UPDATE_ALL = 'UPA'
+ALL = 'all'
 NOIMAGE = 'noimage.png'
 
+# seconds during which a snapshot is shown again instead of fetching a new one
+DEFAULT_FRESHNESS = 5
+SNAPSHOT_TIMEOUT = 8
+JPEG_MAGIC = b'\xff\xd8'
+# size of one camera in the "show all" grid
+DEFAULT_TILE_SIZE = (640, 480)
+
+# Motion detection, per camera under 'motion'. Frames are compared at MOTION_SIZE in grayscale.
+MOTION_SIZE = (64, 48)
+DEFAULT_MOTION_INTERVAL = 30
+DEFAULT_MOTION_THRESHOLD = 0.05  # fraction of pixels that have to change
+DEFAULT_MOTION_PIXEL_THRESHOLD = 0.1  # change in brightness (0 to 1) for a pixel to count
+DEFAULT_MOTION_LEARNING_RATE = 0.1  # how quickly the background follows the picture
+DEFAULT_MOTION_COOLDOWN = 300
+
+
+class CameraFrame:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.content = None
+        self.fetched_at = 0
+
+
+class MotionState:
+    def __init__(self, config):
+        self.interval = config.get('interval', DEFAULT_MOTION_INTERVAL)
+        self.threshold = config.get('threshold', DEFAULT_MOTION_THRESHOLD)
+        self.pixel_threshold = config.get('pixel_threshold', DEFAULT_MOTION_PIXEL_THRESHOLD)
+        self.learning_rate = config.get('learning_rate', DEFAULT_MOTION_LEARNING_RATE)
+        self.cooldown = config.get('cooldown', DEFAULT_MOTION_COOLDOWN)
+        self.next_sample = 0
+        self.last_alert = None
+        self.background = None
+
+    def update(self, sample):
+        """Compares sample with the background and blends it in. Returns the fraction of changed pixels."""
+        if self.background is None:
+            self.background = sample
+            return 0.0
+        changed = np.count_nonzero(np.abs(sample - self.background) > self.pixel_threshold) / sample.size
+        self.background += self.learning_rate * (sample - self.background)
+        return changed
+
+
 class WebcamHandler(BaseHandler):
     def __init__(self, config, messenger, service_hub):
         super().__init__(config, messenger, service_hub, key="webcam", name="Webcams")
         if 'webcam' in config:
             self.cams = config['webcam'].get('cams', [])
-            self.tmp_path = config['webcam'].get('tmp_path', '/tmp/campic.jpg')
+            self.freshness = config['webcam'].get('freshness', DEFAULT_FRESHNESS)
+            # longest side in pixels, larger snapshots are scaled down before sending
+            self.max_size = config['webcam'].get('max_size')
+            self.frames = {cam['name']: CameraFrame() for cam in self.cams}
+            # motion: true turns it on with the defaults
+            self.motion = {
+                cam['name']: MotionState(cam['motion'] if isinstance(cam['motion'], dict) else {})
+                for cam in self.cams if cam.get('motion')
+            }
+            self.tile_size = tuple(config['webcam'].get('tile_size', DEFAULT_TILE_SIZE))
+            self.fetch_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, len(self.cams)),
+                thread_name_prefix='webcam',
+            )
             self.enabled = True
         else:
             self.enabled = False
 
+    def teardown(self):
+        if self.enabled:
+            self.fetch_pool.shutdown(wait=False, cancel_futures=True)
+
+    def schedule(self):
+        if not self.enabled or not self.motion:
+            return None
+        return Interval(min(state.interval for state in self.motion.values()))
+
+    def run_periodically(self, db):
+        now = time.monotonic()
+        # a second of slack, so a camera sampled on every tick isn't skipped for starting a bit late
+        due = [cam for cam, state in self.motion.items() if state.next_sample <= now + 1]
+        futures = [self.fetch_pool.submit(self.check_motion, cam) for cam in due]
+        for cam, future in zip(due, futures):
+            self.motion[cam].next_sample = now + self.motion[cam].interval
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning("Couldn't check {} for motion: {}".format(cam, e))
+
+    @staticmethod
+    def motion_sample(content):
+        im = Image.open(io.BytesIO(content))
+        im.draft('L', MOTION_SIZE)
+        im = im.convert('L').resize(MOTION_SIZE, Image.BILINEAR)
+        return np.asarray(im, dtype=np.float32) / 255
+
+    def check_motion(self, cam):
+        state = self.motion[cam]
+        content = self.get_frame(cam, max_age=state.interval / 2)
+        changed = state.update(self.motion_sample(content))
+        if self._debug:
+            logger.info("{} camera: {:.1%} changed".format(cam, changed))
+        if changed < state.threshold:
+            return
+        now = time.monotonic()
+        if state.last_alert is not None and now - state.last_alert < state.cooldown:
+            return
+        state.last_alert = now
+
+        config = next(c for c in self.cams if c['name'] == cam)
+        msg = {
+            'message': "Something is moving on the {} camera ({})".format(cam, get_timestamp()),
+            'photo': content,
+            'buttons': [[{
+                'text': "Update",
+                'data': "{}§{}".format(UPDATE, cam)
+            }]],
+        }
+        for recipient_id in config.get('users') or [None]:
+            self._messenger.send_message_from_thread(msg, key=self.key, recipient_id=recipient_id)
+
     def matches_message(self, message):
         if not self.enabled:
             return False
         if message.lower().startswith('show '):
             l = message[5:].lower()
+            if l.strip() == ALL:
+                return True
             return any([any([l.startswith(prefix) for prefix in x['prefices']])
                         for x in self.cams])
 
+    def routing_prefixes(self):
+        if not self.enabled:
+            return []
+        return ['show ' + ALL] + ['show ' + prefix for x in self.cams for prefix in x['prefices']]
+
     def help(self, permission):
         if not self.enabled:
             return
         if permission >= PERM_ADMIN:
             return {
                 'summary': "Shows you snapshots from your webcam feeds",
-                'examples': ["show living room"],
+                'examples': ["show living room", "show all"],
             }
 
+    def may_see(self, cam, actor_id, permission):
+        return ('users' in cam and str(actor_id) in cam['users']) \
+            or ('users' not in cam and permission >= PERM_ADMIN)
+
     def handle(self, message, **kwargs):
         l = message[5:].lower()
+        if l.strip() == ALL:
+            return self.get_grid(kwargs['actor_id'], kwargs['permission'])
         for cam in self.cams:
             for prefix in cam['prefices']:
                 if l.startswith(prefix):
-                    if ('users' in cam and str(kwargs['actor_id']) in cam['users']) \
-                        or ('users' not in cam and kwargs['permission'] >= PERM_ADMIN):
+                    if self.may_see(cam, kwargs['actor_id'], kwargs['permission']):
                         return self.get_snapshot(cam['name'])
                     else:
                         return "Sorry, you don't get to see this camera."
@@ -51,22 +185,118 @@ class WebcamHandler(BaseHandler):
         cmd = data[0]
 
         if cmd == UPDATE:
-            resp = self.get_snapshot(data[1], include_timestamp=True)
+            resp = self.get_snapshot(data[1], include_timestamp=True, max_age=0)
             resp['answer'] = "Updated!"
             return resp
+        if cmd == UPDATE_ALL:
+            resp = self.get_grid(kwargs['actor_id'], kwargs['permission'], include_timestamp=True, max_age=0)
+            if isinstance(resp, dict):
+                resp['answer'] = "Updated!"
+            return resp
+
+    def get_frame(self, cam, max_age=None):
+        """
+        Latest snapshot of cam, ready to be sent. Snapshots younger than max_age seconds (the
+        configured freshness by default) are reused; concurrent askers wait for one download.
+        """
+        if max_age is None:
+            max_age = self.freshness
+        config = next(c for c in self.cams if c['name'] == cam)
+        frame = self.frames[cam]
+        with frame.lock:
+            if frame.content is None or time.monotonic() - frame.fetched_at >= max_age:
+                resp = self._http.get(config['url'], timeout=SNAPSHOT_TIMEOUT)
+                resp.raise_for_status()
+                frame.content = self.prepare_photo(resp.content, config.get('max_size', self.max_size))
+                frame.fetched_at = time.monotonic()
+            return frame.content
+
+    @staticmethod
+    def prepare_photo(content, max_size=None):
+        # Telegram takes JPEGs as they are, anything else is converted to PNG
+        is_jpeg = content.startswith(JPEG_MAGIC)
+        if is_jpeg and not max_size:
+            return content
+        im = Image.open(io.BytesIO(content))
+        if max_size and max(im.size) > max_size:
+            im.draft('RGB', (max_size, max_size))
+            im.thumbnail((max_size, max_size))
+        elif is_jpeg:
+            return content
+        out = io.BytesIO()
+        if is_jpeg:
+            im.save(out, format='JPEG', quality=85)
+        else:
+            im.save(out, format='PNG')
+        return out.getvalue()
+
+    def tile(self, content):
+        im = Image.open(io.BytesIO(content))
+        # lets the JPEG decoder skip most of the pixels we'd throw away anyway
+        im.draft('RGB', self.tile_size)
+        im = im.convert('RGB')
+        im.thumbnail(self.tile_size)
+        return im
+
+    def get_grid(self, actor_id, permission, include_timestamp=False, max_age=None):
+        """All cameras the actor may see at once, tiled into one picture."""
+        cams = [cam['name'] for cam in self.cams if self.may_see(cam, actor_id, permission)]
+        if not cams:
+            return "Sorry, you don't get to see any camera."
+
+        # all downloads run at the same time, so the slowest camera's timeout bounds the whole grid
+        futures = [self.fetch_pool.submit(lambda cam: self.tile(self.get_frame(cam, max_age)), cam) for cam in cams]
+        concurrent.futures.wait(futures, timeout=SNAPSHOT_TIMEOUT + 1)
+        tiles = []
+        missing = []
+        for cam, future in zip(cams, futures):
+            if future.done() and future.exception() is None:
+                tiles.append(future.result())
+            else:
+                if future.done():
+                    logger.warning("No snapshot from {}: {}".format(cam, future.exception()))
+                missing.append(cam)
+
+        buttons = [[{
+            'text': "Update",
+            'data': "{}§{}".format(UPDATE_ALL, ALL),
+        }]]
+        message = 'All cameras'
+        if include_timestamp:
+            message = f'{message} ({get_timestamp()})'
+        if missing:
+            message = "{}\n{} didn't answer. :(".format(message, ", ".join(missing))
+        if not tiles:
+            return {
+                'photo': NOIMAGE,
+                'message': message,
+                'buttons': buttons,
+            }
+
+        columns = math.ceil(math.sqrt(len(tiles)))
+        rows = math.ceil(len(tiles) / columns)
+        width, height = self.tile_size
+        grid = Image.new('RGB', (columns * width, rows * height))
+        for index, im in enumerate(tiles):
+            x = (index % columns) * width + (width - im.width) // 2
+            y = (index // columns) * height + (height - im.height) // 2
+            grid.paste(im, (x, y))
+        out = io.BytesIO()
+        grid.save(out, format='JPEG', quality=85)
+
+        return {
+            'message': message,
+            'photo': out.getvalue(),
+            'buttons': buttons,
+        }
 
-    def get_snapshot(self, cam, include_timestamp=False):
+    def get_snapshot(self, cam, include_timestamp=False, max_age=None):
         buttons = [[{
                 'text': "Update",
                 'data': "{}§{}".format(UPDATE, cam)
             }]]
         try:
-            url = next(c['url'] for c in self.cams if c['name'] == cam)
-            resp = requests.get(url, timeout=8)
-            with open("{}.jpg".format(self.tmp_path), 'wb') as file:
-                file.write(resp.content)
-            im = Image.open("{}.jpg".format(self.tmp_path))
-            im.save("{}.png".format(self.tmp_path))
+            photo = self.get_frame(cam, max_age)
 
             message = f'{cam} camera'
             if include_timestamp:
@@ -74,7 +304,7 @@ class WebcamHandler(BaseHandler):
 
             return {
                 'message': message,
-                'photo': f'{self.tmp_path}.png',
+                'photo': photo,
                 'buttons': buttons,
             }
         except requests.exceptions.ConnectionError:
@@ -95,7 +325,7 @@ class WebcamHandler(BaseHandler):
                 'buttons': buttons,
             }
         except Exception as e:
-            print(e)
+            logger.exception(e)
             return {
                 'photo': NOIMAGE,
                 'message': "{} Something went horribly wrong with {} webcam. :(".format(get_exclamation(), cam),
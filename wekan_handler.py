@@ -5,6 +5,8 @@ import random
 from utils import PERM_ADMIN
 from utils import get_exclamation
 from utils import get_affirmation
+from db_schema import WEKAN_REPORTS, to_epoch
+from scheduler import Interval
 from wekan_service import WekanService
 
 logger = logging.getLogger(__name__)
@@ -60,6 +62,16 @@ class WekanHandler(BaseHandler):
         return False
 
 
+    def routing_prefixes(self):
+        if not self.enabled:
+            return []
+        return CARD_SYNONYMS + ['do ', 'i do ', 'we do ', 'toggle task report']
+
+    def routing_suffixes(self):
+        if not self.enabled:
+            return []
+        return [' ' + it for it in CARD_SYNONYMS]
+
     def help(self, permission):
         if not self.enabled:
             return
@@ -417,18 +429,18 @@ class WekanHandler(BaseHandler):
 
     def toggle_report(self, actor, db):
         table = db['wekan']
-        entry = table.find_one(actor=actor)
+        entry = WEKAN_REPORTS.load(table.find_one(actor=actor))
         if not entry:
             entry = {
                 'actor': actor,
                 'enabled': True,
                 'next_message': self.get_next_reminder_date(),
             }
-            table.insert(entry)
+            table.insert(WEKAN_REPORTS.dump(entry))
         else:
             entry['enabled'] = not entry['enabled']
-            entry['next_message'] = self.get_next_reminder_date(),
-            table.update(entry, ['actor'])
+            entry['next_message'] = self.get_next_reminder_date()
+            table.update(WEKAN_REPORTS.dump(entry), ['actor'])
 
         if entry['enabled']:
             return "You will receive daily task reports."
@@ -482,6 +494,11 @@ class WekanHandler(BaseHandler):
         return tomorrow_morning
 
 
+    def schedule(self):
+        if not self.enabled:
+            return None
+        return Interval(60)
+
     def run_periodically(self, db):
         debug = self._debug
         table = db['wekan']
@@ -490,16 +507,14 @@ class WekanHandler(BaseHandler):
             logger.info("Querying wekan reports...")
 
         now = datetime.datetime.now()
-        reminders = db.query('SELECT * FROM wekan WHERE enabled IS TRUE AND next_message < :now', now=now)
+        reminders = db.query('SELECT * FROM wekan WHERE enabled = 1 AND next_message_ts < :now', now=to_epoch(now))
 
         count = 0
-        for reminder in reminders:
+        for row in reminders:
+            reminder = WEKAN_REPORTS.load(row)
             count += 1
             if debug:
                 logger.info("Sending wekan report {}".format(count))
-            # this is so stupid I can't even
-            # dataset returns dates as string but only accepts them as datetime
-            reminder['next_message'] = datetime.datetime.strptime(reminder['next_message'], '%Y-%m-%d %H:%M:%S.%f')
 
             lists = [l['id'] for l in self.config['source_lists']]
             msg = self.get_card_text(reminder['actor'], lists, [])
@@ -512,7 +527,7 @@ class WekanHandler(BaseHandler):
 
             if debug:
                 logger.info("Updating report {}".format(count))
-            table.update(reminder, ['actor'])
+            table.update(WEKAN_REPORTS.dump(reminder), ['actor'])
             if debug:
                 logger.info("Finished report {}".format(count))
         if debug:
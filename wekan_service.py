@@ -1,11 +1,11 @@
 import datetime
 
 from dateutil import parser
-import requests
 
 
 class WekanService:
-    def __init__(self, config):
+    def __init__(self, config, http):
+        self.http = http
         if 'wekan' in config:
             self.config = config['wekan']
             self.enabled = True
@@ -142,9 +142,9 @@ class WekanService:
         if payload:
             if method == 'GET':
                 method = 'POST'
-            data = requests.request(method, url, json=payload, headers=headers)
+            data = self.http.request(method, url, json=payload, headers=headers)
         else:
-            data = requests.get(url, headers=headers)
+            data = self.http.get(url, headers=headers)
         return data.json()
 
     def _token_valid(self):
@@ -160,7 +160,7 @@ class WekanService:
             'username': self.config['username'],
             'password': self.config['password'],
         }
-        auth = requests.post("{}/users/login".format(base_url), headers=headers, json=login).json()
+        auth = self.http.post("{}/users/login".format(base_url), headers=headers, json=login).json()
         self.token = auth['token']
         self.token_expires = parser.parse(auth['tokenExpires'])
         self.wekan_id = auth['id']